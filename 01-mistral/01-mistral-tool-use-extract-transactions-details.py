@@ -18,23 +18,248 @@ data = {
 # Create DataFrame
 df = pd.DataFrame(data)
 
+# Scanning the DataFrame on every tool call is O(n): `in df.transaction_id.values` walks the whole column, 
+# and the boolean mask walks it once more. With tens of millions of transactions that adds up quickly. 
+# Instead we wrap the DataFrame in a small store which builds a transaction_id -> row position index once, 
+# so every lookup afterwards is a single dictionary hit.
+
+class TransactionStore:
+    """Payment transactions indexed by transaction_id for O(1) lookups."""
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.index = {transaction_id: position for position, transaction_id in enumerate(self.column('transaction_id'))}
+
+    def __contains__(self, transaction_id: str) -> bool:
+        return self.position(transaction_id) is not None
+
+    def position(self, transaction_id: str):
+        """Return the row position of transaction_id, or None if the transaction does not exist."""
+        return self.index.get(transaction_id)
+
+    def column(self, name: str) -> pd.Series:
+        """Return a single column of the transaction table."""
+        return self.df[name]
+
+    def arrow_column(self, name: str):
+        """Return a single column of the transaction table as an Arrow array."""
+        return pa.array(self.df[name])
+
+    def lookup(self, transaction_id: str, column: str):
+        """Return the value of column for transaction_id, or None if the transaction does not exist."""
+        position = self.position(transaction_id)
+        if position is None:
+            return None
+        value = self.column(column).iat[position]
+        # Convert numpy scalars back to plain Python values so they serialize with json.dumps
+        return value.item() if hasattr(value, 'item') else value
+
+    def lookup_many(self, transaction_ids: list, columns: list) -> pd.DataFrame:
+        """Return the requested columns for every known transaction id in a single vectorized gather."""
+        found = [(transaction_id, self.position(transaction_id)) for transaction_id in transaction_ids]
+        found = [(transaction_id, position) for transaction_id, position in found if position is not None]
+        found_ids = [transaction_id for transaction_id, _ in found]
+        positions = [position for _, position in found]
+        return pd.DataFrame(
+            {column: self.column(column).take(positions).to_numpy() for column in columns},
+            index=found_ids,
+        )
+
+# A Python dict literal is fine for a handful of rows, but real payment ledgers run into gigabytes. 
+# For those we keep the ledger on disk in a columnar file (Arrow IPC or Parquet) and memory map it. 
+# Only the columns a tool actually asks for are loaded, so startup time and memory stay flat as the ledger grows. 
+# An uncompressed Arrow IPC file is read zero-copy: the column buffers point straight into the mapped file. 
+# To keep it that way the columns are handed to pandas as Arrow-backed Series instead of one Python string object per row, 
+# and instead of a dict with one entry per transaction, the id index is a sorted order computed by Arrow and searched with bisect.
+
+import bisect
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+def write_transactions(df: pd.DataFrame, path: str):
+    """Write the transaction table to an Arrow IPC (.arrow) or Parquet (.parquet) file."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if path.endswith('.parquet'):
+        pq.write_table(table, path)
+    else:
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+class ColumnarTransactionStore(TransactionStore):
+    """Payment transactions read from a memory-mapped columnar file, one column at a time."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.columns = {}
+        if path.endswith('.parquet'):
+            self.table = None
+        else:
+            self.table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        transaction_ids = self.arrow_column('transaction_id')
+        self.order = pc.sort_indices(transaction_ids)
+        self.sorted_ids = transaction_ids.take(self.order)
+
+    def arrow_column(self, name: str) -> pa.ChunkedArray:
+        if self.table is None:
+            return pq.read_table(self.path, columns=[name], memory_map=True).column(name)
+        return self.table.column(name)
+
+    def column(self, name: str) -> pd.Series:
+        if name not in self.columns:
+            self.columns[name] = self.arrow_column(name).to_pandas(types_mapper=pd.ArrowDtype)
+        return self.columns[name]
+
+    def position(self, transaction_id: str):
+        # Binary search over the sorted ids, only the ids it compares against are turned into Python strings
+        sorted_ids = self.sorted_ids
+        found = bisect.bisect_left(range(len(sorted_ids)), transaction_id, key=lambda position: sorted_ids[position].as_py())
+        if found < len(sorted_ids) and sorted_ids[found].as_py() == transaction_id:
+            return self.order[found].as_py()
+        return None
+
+# Point TRANSACTIONS_PATH at a ledger file to serve the tools from disk; otherwise we use the in-memory example data.
+
+import os
+
+transactions_path = os.environ.get('TRANSACTIONS_PATH')
+if transactions_path:
+    store = ColumnarTransactionStore(transactions_path)
+else:
+    store = TransactionStore(df)
+
 # In many cases, we might have multiple tools at our disposal. 
 # For example, let’s consider we have two functions as our two tools: retrieve_payment_status and retrieve_payment_date 
 # to retrieve payment status and payment date given transaction ID.
 
-def retrieve_payment_status(df: data, transaction_id: str) -> str:
-    if transaction_id in df.transaction_id.values: 
-        return json.dumps({'status': df[df.transaction_id == transaction_id].payment_status.item()})
+def retrieve_payment_status(store: TransactionStore, transaction_id: str) -> str:
+    if transaction_id in store: 
+        return json.dumps({'status': store.lookup(transaction_id, 'payment_status')})
     return json.dumps({'error': 'transaction id not found.'})
 
-def retrieve_payment_date(df: data, transaction_id: str) -> str:
-    if transaction_id in df.transaction_id.values: 
-        return json.dumps({'date': df[df.transaction_id == transaction_id].payment_date.item()})
+def retrieve_payment_date(store: TransactionStore, transaction_id: str) -> str:
+    if transaction_id in store: 
+        return json.dumps({'date': store.lookup(transaction_id, 'payment_date')})
     return json.dumps({'error': 'transaction id not found.'})
 
+# Users often ask about several transactions in one message. Rather than one tool call (and one LLM round-trip) per transaction id, 
+# we also offer a batched tool which takes a list of transaction ids and a list of requested fields. 
+# All ids are resolved against the DataFrame in one go and returned as a single compact JSON payload, column by column.
+
+payment_fields = {
+    'status': 'payment_status',
+    'date': 'payment_date',
+}
+
+def retrieve_payment_details(store: TransactionStore, transaction_ids: list, fields: list) -> str:
+    unknown_fields = [field for field in fields if field not in payment_fields]
+    if unknown_fields:
+        return json.dumps({'error': f'unknown fields: {unknown_fields}.'})
+    # Preserve the order the ids were asked in, but only resolve each id once
+    transaction_ids = list(dict.fromkeys(transaction_ids))
+    rows = store.lookup_many(transaction_ids, [payment_fields[field] for field in fields])
+    result = {'transaction_id': rows.index.tolist()}
+    for field in fields:
+        result[field] = rows[payment_fields[field]].tolist()
+    not_found = [transaction_id for transaction_id in transaction_ids if transaction_id not in store]
+    if not_found:
+        result['not_found'] = not_found
+    return json.dumps(result, separators=(',', ':'))
+
+# Range and aggregate questions ("payments between two dates", "total paid per customer", "unpaid amount by status") 
+# would need a full DataFrame filter on every call. Instead we sort the payments by date once, so a date range is two binary searches, 
+# and we keep the totals per customer and per status. Both are built on the first range or aggregate question rather than at startup, 
+# so a ledger that is only asked for payment statuses never loads the date, amount and customer columns. 
+# The sort and the totals are computed by Arrow on the columns as they are, so building them never creates a Python object per payment, 
+# and a date range returns at most payments_page_size payments per call, with an offset to page through the rest.
+
+class PaymentAnalytics:
+    """Sorted payment_date index plus per-customer and per-status aggregates over the transaction store."""
+
+    def __init__(self, store: TransactionStore):
+        dates = store.arrow_column('payment_date')
+        if not pa.types.is_string(dates.type):
+            dates = pc.cast(dates, pa.string())
+        self.order = pc.sort_indices(dates)
+        self.dates = dates.take(self.order)
+        self.transaction_ids = store.arrow_column('transaction_id')
+        self.amounts = pc.cast(store.arrow_column('payment_amount'), pa.float64())
+        payments = pa.table({
+            'customer_id': store.arrow_column('customer_id'),
+            'payment_status': store.arrow_column('payment_status'),
+            'payment_amount': self.amounts,
+        })
+        by_status = payments.group_by('payment_status').aggregate([('payment_amount', 'sum')])
+        self.amount_by_status = dict(zip(by_status['payment_status'].to_pylist(), by_status['payment_amount_sum'].to_pylist()))
+        paid = payments.filter(pc.equal(payments['payment_status'], 'Paid'))
+        per_customer = paid.group_by('customer_id').aggregate([('payment_amount', 'sum')])
+        self.paid_per_customer = dict(zip(per_customer['customer_id'].to_pylist(), per_customer['payment_amount_sum'].to_pylist()))
+
+    def between(self, start_date: str, end_date: str) -> slice:
+        """Return the slice of the date index covering start_date to end_date, both inclusive."""
+        # Like the id index, only the dates the binary search compares against are turned into Python strings
+        positions = range(len(self.dates))
+        key = lambda position: self.dates[position].as_py()
+        return slice(bisect.bisect_left(positions, start_date, key=key), bisect.bisect_right(positions, end_date, key=key))
+
+    def payments(self, window: slice) -> pa.Table:
+        """Return transaction_id, date and amount of the payments in a slice of the date index, in date order."""
+        rows = self.order[window]
+        return pa.table({
+            'transaction_id': self.transaction_ids.take(rows),
+            'date': self.dates[window],
+            'amount': self.amounts.take(rows),
+        })
+
+    def total(self, window: slice) -> float:
+        """Return the total amount of the payments in a slice of the date index."""
+        return pc.sum(self.amounts.take(self.order[window])).as_py() or 0.0
+
+import threading
+
+analytics = None
+analytics_lock = threading.Lock()
+
+def get_analytics() -> PaymentAnalytics:
+    """Return the payment analytics, building them from the store on first use."""
+    global analytics
+    with analytics_lock:
+        if analytics is None:
+            analytics = PaymentAnalytics(store)
+        return analytics
+
+payments_page_size = 100
+
+def retrieve_payments_between_dates(analytics: PaymentAnalytics, start_date: str, end_date: str, offset: int = 0) -> str:
+    window = analytics.between(start_date, end_date)
+    count = window.stop - window.start
+    offset = max(offset, 0)
+    page = slice(min(window.start + offset, window.stop), min(window.start + offset + payments_page_size, window.stop))
+    payments = analytics.payments(page)
+    result = {
+        'transaction_id': payments['transaction_id'].to_pylist(),
+        'date': payments['date'].to_pylist(),
+        'amount': payments['amount'].to_pylist(),
+        'count': count,
+        'total': round(analytics.total(window), 2),
+    }
+    if page.stop < window.stop:
+        result['next_offset'] = page.stop - window.start
+    return json.dumps(result, separators=(',', ':'))
+
+def retrieve_total_paid_per_customer(analytics: PaymentAnalytics, customer_id: str = None) -> str:
+    if customer_id is None:
+        return json.dumps({customer: round(total, 2) for customer, total in analytics.paid_per_customer.items()})
+    return json.dumps({customer_id: round(analytics.paid_per_customer.get(customer_id, 0.0), 2)})
+
+def retrieve_amount_by_status(analytics: PaymentAnalytics, status: str = None) -> str:
+    if status is None:
+        return json.dumps({status: round(total, 2) for status, total in analytics.amount_by_status.items()})
+    return json.dumps({status: round(analytics.amount_by_status.get(status, 0.0), 2)})
+
 # In order for Mistral models to understand the functions, we need to outline the function specifications with a JSON schema. 
 # Specifically, we need to describe the type, function name, function description, function parameters, and the required parameter for the function. 
-# Since we have two functions here, let’s list two function specifications in a list.
+# Since we have six functions here, let’s list six function specifications in a list.
 
 tools = [
     {
@@ -70,17 +295,104 @@ tools = [
                 "required": ["transaction_id"],
             },
         },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "retrieve_payment_details",
+            "description": "Get the payment status and/or payment date of one or more transactions in a single call",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "transaction_ids": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The transaction ids.",
+                    },
+                    "fields": {
+                        "type": "array",
+                        "items": {"type": "string", "enum": list(payment_fields)},
+                        "description": "The payment details to retrieve for every transaction.",
+                    }
+                },
+                "required": ["transaction_ids", "fields"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "retrieve_payments_between_dates",
+            "description": "Get the payments made between two dates, inclusive, with their count and total amount. At most 100 payments are listed per call; if next_offset is returned, call again with that offset to get the next ones",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "start_date": {
+                        "type": "string",
+                        "description": "The first date of the range, in YYYY-MM-DD format.",
+                    },
+                    "end_date": {
+                        "type": "string",
+                        "description": "The last date of the range, in YYYY-MM-DD format.",
+                    },
+                    "offset": {
+                        "type": "integer",
+                        "description": "The number of payments in the range to skip, from a previous next_offset. Leave out to start at the first payment.",
+                    }
+                },
+                "required": ["start_date", "end_date"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "retrieve_total_paid_per_customer",
+            "description": "Get the total amount paid per customer, or for a single customer",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "customer_id": {
+                        "type": "string",
+                        "description": "The customer id. Leave out to get the totals of every customer.",
+                    }
+                },
+                "required": [],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "retrieve_amount_by_status",
+            "description": "Get the total payment amount per payment status (e.g. Paid, Unpaid, Pending), or for a single status",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "status": {
+                        "type": "string",
+                        "description": "The payment status. Leave out to get the totals of every status.",
+                    }
+                },
+                "required": [],
+            },
+        },
     }
 ]
 
 import functools
 
-# Then we organize the two functions into a dictionary where keys represent the function name, and values are the function with the df defined. 
+# Then we organize the six functions into a dictionary where keys represent the function name, and values are the function with the store 
+# (or the payment analytics) bound to it. 
 # This allows us to call each function based on its function name.
 
 names_to_functions = {
-    'retrieve_payment_status': functools.partial(retrieve_payment_status, df=df),
-    'retrieve_payment_date': functools.partial(retrieve_payment_date, df=df)
+    'retrieve_payment_status': functools.partial(retrieve_payment_status, store=store),
+    'retrieve_payment_date': functools.partial(retrieve_payment_date, store=store),
+    'retrieve_payment_details': functools.partial(retrieve_payment_details, store=store),
+    'retrieve_payments_between_dates': lambda **arguments: retrieve_payments_between_dates(get_analytics(), **arguments),
+    'retrieve_total_paid_per_customer': lambda **arguments: retrieve_total_paid_per_customer(get_analytics(), **arguments),
+    'retrieve_amount_by_status': lambda **arguments: retrieve_amount_by_status(get_analytics(), **arguments)
 }
 
 # Suppose a user asks the following question: “What’s the status of my transaction?” 
@@ -101,46 +413,384 @@ api_key = os.environ["MISTRAL_API_KEY"]
 model = "mistral-large-latest"
 
 client = Mistral(api_key=api_key)
-response = client.chat.complete(
-    model = model,
-    messages = messages,
-    tools = tools,
-    tool_choice = "any",
-)
-
-print(f'Response from LLM:\n\n{response}\n')
-
-# Let’s add the response message to the messages list.
-messages.append(response.choices[0].message)
-
-# How do we execute the function? Currently, it is the user’s responsibility to execute these functions and the function execution lies on the user side. 
-# In the future, we may introduce some helpful functions that can be executed server-side.
-# Let’s extract some useful function information from model response including function_name and function_params. 
-# It’s clear here that our Mistral model has chosen to use the function retrieve_payment_status with the parameter transaction_id set to T1001.
-
-
-import json
-
-tool_call = response.choices[0].message.tool_calls[0]
-function_name = tool_call.function.name
-function_params = json.loads(tool_call.function.arguments)
-print("\nfunction_name: ", function_name, "\nfunction_params: ", function_params)
-
-# Now we can execute the function and we get the function output '{"status": "Paid"}'.
-
-function_result = names_to_functions[function_name](**function_params)
-
-print(f'\n\nFunction Result: \n\n{function_result}')
 
-# We can now provide the output from the tools to Mistral models, and in return, 
-# the Mistral model can produce a customised final response for the specific user.
-
-messages.append({"role":"tool", "name":function_name, "content":function_result, "tool_call_id":tool_call.id})
-
-response = client.chat.complete(
-    model = model, 
-    messages = messages
+import email.utils
+import threading
+import time
+import httpx
+from mistralai import models
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt, stop_before_delay
+
+# Only transient errors are worth retrying: rate limits, timeouts, dropped connections and server errors. 
+# Bad requests, authentication and permission errors are fatal and fail straight away. 
+# When the provider tells us how long to wait (the Retry-After header) we wait exactly that long, otherwise we back off exponentially with jitter. 
+# All attempts share one deadline, and a circuit breaker fails fast while the provider keeps failing instead of piling more requests onto it.
+
+REQUEST_DEADLINE = 60  # seconds, across all attempts of one request
+
+def is_retryable(exception):
+    if isinstance(exception, httpx.TransportError):
+        return True
+    return isinstance(exception, models.SDKError) and (exception.status_code in (408, 409, 429) or exception.status_code >= 500)
+
+def retry_after(exception):
+    """Return the delay in seconds requested by the provider's Retry-After header, if any."""
+    response = getattr(exception, "raw_response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+backoff = wait_random_exponential(multiplier=1, max=40)
+
+def wait_for_provider(retry_state):
+    delay = retry_after(retry_state.outcome.exception())
+    return delay if delay is not None else backoff(retry_state)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Stop calling a provider for reset_timeout seconds after failure_threshold consecutive transient failures."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if self.opened_at is None:
+                return self
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"provider unavailable, retry in {self.reset_timeout - (time.monotonic() - self.opened_at):.1f} seconds")
+            # Half open: let this request through as a probe, the others keep failing fast until it reports back
+            self.opened_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exception, traceback):
+        with self.lock:
+            if exception is None or not is_retryable(exception):
+                # The provider answered, even a refused request (e.g. a 400) shows it is up again
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+        return False
+
+circuit_breaker = CircuitBreaker()
+
+provider_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_for_provider,
+    stop=stop_after_attempt(5) | stop_before_delay(REQUEST_DEADLINE),
+    reraise=True,
 )
 
-print(f'\n\nFinal Response:\n\n{response.choices[0].message.content}\n\n')
-
+# Caching completions
+# Regression suites and FAQ-style questions replay the same prompts over and over, and each replay pays the full provider latency and cost. 
+# Setting COMPLETION_CACHE_PATH turns on a disk-backed completion cache. Requests are keyed on a hash of the canonical JSON 
+# of the model, messages, tools and tool_choice, and the responses are kept in SQLite. SQLite's locking (in WAL mode) makes the cache 
+# safe to share between processes, and once it holds more than max_entries responses the least recently used ones are evicted. 
+# Streamed requests are never cached.
+
+import hashlib
+import sqlite3
+
+class CompletionCache:
+    """SQLite-backed, size-bounded LRU cache of chat completions."""
+
+    def __init__(self, path, max_entries=10_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        with self.connection() as cache_conn:
+            cache_conn.execute("PRAGMA journal_mode=WAL")
+            cache_conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            cache_conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, so every thread opens its own
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return self.local.conn
+
+    def key(self, **request):
+        def canonical(value):
+            if hasattr(value, "model_dump"):
+                return value.model_dump(exclude_none=True)
+            raise TypeError(f"can't cache a request containing {type(value).__name__}")
+        payload = json.dumps(request, sort_keys=True, separators=(",", ":"), default=canonical)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.connection() as cache_conn:
+            row = cache_conn.execute("SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                cache_conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return None if row is None else row[0]
+
+    def put(self, key, response):
+        with self.connection() as cache_conn:
+            cache_conn.execute(
+                "INSERT OR REPLACE INTO completions (key, response, last_used) VALUES (?, ?, ?)", (key, response, time.time())
+            )
+            cache_conn.execute(
+                "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+completion_cache = CompletionCache(os.environ["COMPLETION_CACHE_PATH"]) if os.environ.get("COMPLETION_CACHE_PATH") else None
+
+@provider_retry
+def chat_complete(**kwargs):
+    cache_key = None
+    if completion_cache is not None:
+        cache_key = completion_cache.key(**kwargs)
+        cached = completion_cache.get(cache_key)
+        if cached is not None:
+            return models.ChatCompletionResponse.model_validate_json(cached)
+    with circuit_breaker:
+        response = client.chat.complete(**kwargs)
+    if cache_key is not None:
+        completion_cache.put(cache_key, response.model_dump_json())
+    return response
+
+@provider_retry
+def chat_stream(**kwargs):
+    # Only opening the stream is retried, a stream that breaks off halfway is not replayed
+    with circuit_breaker:
+        return client.chat.stream(**kwargs)
+
+# Streaming tool calls
+# Normally we only see the tool calls once the whole assistant message has arrived, so no tool can start before the model finishes writing the last one. 
+# When streaming, tool calls arrive as deltas. We accumulate the arguments of each call and try to parse them as they grow 
+# (jiter can also parse the partial JSON, which is handy for showing progress). 
+# As soon as the arguments of a call form a complete JSON object we hand the call to a thread pool, 
+# so tool execution overlaps with the generation of the remaining tool calls.
+
+import jiter
+from concurrent.futures import ThreadPoolExecutor
+
+stream = True
+
+class StreamingToolCallAssembler:
+    """Assemble streamed tool-call deltas and dispatch each call as soon as its arguments are complete."""
+
+    def __init__(self, functions: dict, executor: ThreadPoolExecutor):
+        self.functions = functions
+        self.executor = executor
+        self.calls = {}
+        self.ids = {}
+        self.futures = {}
+
+    def add(self, tool_call_deltas: list):
+        for delta in tool_call_deltas:
+            # Mistral usually sends every tool call whole and without an index, so fall back to the order of the call ids
+            index = getattr(delta, 'index', None)
+            if index is None:
+                index = self.ids.setdefault(delta.id, len(self.ids)) if delta.id else len(self.calls) - 1
+            call = self.calls.setdefault(index, {'id': None, 'name': '', 'arguments': ''})
+            if delta.id:
+                call['id'] = delta.id
+            if delta.function.name:
+                call['name'] += delta.function.name
+            arguments = delta.function.arguments
+            if isinstance(arguments, dict):
+                arguments = json.dumps(arguments)
+            if arguments:
+                call['arguments'] += arguments
+                self.dispatch_if_complete(index)
+
+    def partial_arguments(self, index: int) -> dict:
+        """Return the arguments generated so far for the tool call at index, parsed from partial JSON."""
+        arguments = self.calls[index]['arguments']
+        return jiter.from_json(arguments.encode(), partial_mode='trailing-strings') if arguments else {}
+
+    def dispatch_if_complete(self, index: int):
+        call = self.calls[index]
+        if index in self.futures or not call['arguments'].rstrip().endswith('}'):
+            return
+        try:
+            arguments = jiter.from_json(call['arguments'].encode())
+        except ValueError:
+            # The closing brace belonged to a nested object or a string, keep accumulating
+            return
+        self.futures[index] = self.executor.submit(self.execute, call['name'], arguments)
+
+    def execute(self, name: str, arguments) -> str:
+        if name not in self.functions:
+            return json.dumps({'error': f'function {name} does not exist.'})
+        if isinstance(arguments, str):
+            try:
+                arguments = jiter.from_json(arguments.encode())
+            except ValueError as e:
+                return json.dumps({'error': f'invalid arguments for {name}: {e}.'})
+        try:
+            return self.functions[name](**arguments)
+        except Exception as e:
+            return json.dumps({'error': f'function {name} failed with error: {e}.'})
+
+    def finish(self) -> tuple:
+        """Wait for every dispatched call and return the assistant message and the tool messages, in call order."""
+        for index, call in self.calls.items():
+            if index not in self.futures:
+                # Calls without arguments, or whose arguments never parsed, are executed (or rejected) now
+                self.futures[index] = self.executor.submit(self.execute, call['name'], call['arguments'] or '{}')
+        ordered = sorted(self.calls)
+        assistant_message = {
+            'role': 'assistant',
+            'content': '',
+            'tool_calls': [
+                {
+                    'id': self.calls[index]['id'],
+                    'type': 'function',
+                    'function': {'name': self.calls[index]['name'], 'arguments': self.calls[index]['arguments']},
+                }
+                for index in ordered
+            ],
+        }
+        tool_messages = [
+            {'role': 'tool', 'name': self.calls[index]['name'], 'content': self.futures[index].result(), 'tool_call_id': self.calls[index]['id']}
+            for index in ordered
+        ]
+        return assistant_message, tool_messages
+
+def stream_chat_completion_with_tools(model, messages, tools, functions, tool_choice='auto'):
+    """Stream a chat completion, executing tool calls while the rest of the response is generated."""
+    with ThreadPoolExecutor() as executor:
+        assembler = StreamingToolCallAssembler(functions, executor)
+        content = ''
+        for event in chat_stream(model = model, messages = messages, tools = tools, tool_choice = tool_choice):
+            if not event.data.choices:
+                continue
+            delta = event.data.choices[0].delta
+            if isinstance(delta.content, str):
+                content += delta.content
+            if delta.tool_calls:
+                assembler.add(delta.tool_calls)
+        if not assembler.calls:
+            return {'role': 'assistant', 'content': content}, []
+        assistant_message, tool_messages = assembler.finish()
+    assistant_message['content'] = content
+    return assistant_message, tool_messages
+
+if stream:
+    assistant_message, tool_messages = stream_chat_completion_with_tools(
+        model, messages, tools, names_to_functions, tool_choice = "any"
+    )
+
+    print(f'Response from LLM:\n\n{assistant_message}\n')
+
+    messages.append(assistant_message)
+    for tool_message in tool_messages:
+        print(f'\n\nFunction Result ({tool_message["name"]}): \n\n{tool_message["content"]}')
+    messages.extend(tool_messages)
+else:
+    response = chat_complete(
+        model = model,
+        messages = messages,
+        tools = tools,
+        tool_choice = "any",
+    )
+
+    print(f'Response from LLM:\n\n{response}\n')
+
+    # Let’s add the response message to the messages list.
+    messages.append(response.choices[0].message)
+
+    # How do we execute the function? Currently, it is the user’s responsibility to execute these functions and the function execution lies on the user side. 
+    # In the future, we may introduce some helpful functions that can be executed server-side.
+    # Let’s extract some useful function information from model response including function_name and function_params. 
+    # It’s clear here that our Mistral model has chosen to use the function retrieve_payment_status with the parameter transaction_id set to T1001.
+
+
+    import json
+
+    # The model may ask for several tools in one turn, so we execute every tool call rather than only the first one.
+    # Each result goes back as its own tool message, matched to its call by tool_call_id.
+
+    for tool_call in response.choices[0].message.tool_calls:
+        function_name = tool_call.function.name
+        function_params = json.loads(tool_call.function.arguments)
+        print("\nfunction_name: ", function_name, "\nfunction_params: ", function_params)
+
+        # Now we can execute the function and we get the function output '{"status": "Paid"}'.
+
+        function_result = names_to_functions[function_name](**function_params)
+
+        print(f'\n\nFunction Result: \n\n{function_result}')
+
+        # We can now provide the output from the tools to Mistral models, and in return, 
+        # the Mistral model can produce a customised final response for the specific user.
+
+        messages.append({"role":"tool", "name":function_name, "content":function_result, "tool_call_id":tool_call.id})
+
+# Waiting for the whole final answer means the user sees nothing until the last token arrives. 
+# In streaming mode we print the tokens as they come in, and record the time to first token and the generation speed.
+
+import time
+
+def stream_chat_completion(model, messages):
+    """Stream a chat completion to stdout and return the full content together with latency statistics."""
+    start = time.perf_counter()
+    first_token_at = None
+    content = ''
+    chunks = 0
+    completion_tokens = None
+    for event in chat_stream(model = model, messages = messages):
+        chunk = event.data
+        if chunk.usage is not None:
+            completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices:
+            continue
+        text = chunk.choices[0].delta.content
+        # delta.content can also be a list of content chunks; as in the tool-calling stream above, only text is kept
+        if not isinstance(text, str) or not text:
+            continue
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        chunks += 1
+        content += text
+        print(text, end='', flush=True)
+    end = time.perf_counter()
+    print()
+    # Fall back to counting streamed chunks when the provider does not report usage
+    completion_tokens = completion_tokens or chunks
+    generation_time = end - (first_token_at or end)
+    stats = {
+        'time_to_first_token': None if first_token_at is None else first_token_at - start,
+        'completion_tokens': completion_tokens,
+        'tokens_per_second': completion_tokens / generation_time if generation_time > 0 else None,
+    }
+    return content, stats
+
+if stream:
+    print('\n\nFinal Response:\n')
+    content, stats = stream_chat_completion(model, messages)
+    print(f'\nStreaming stats: {stats}\n\n')
+else:
+    response = chat_complete(
+        model = model, 
+        messages = messages
+    )
+
+    print(f'\n\nFinal Response:\n\n{response.choices[0].message.content}\n\n')
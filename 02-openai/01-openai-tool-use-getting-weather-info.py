@@ -9,30 +9,78 @@
 # as well as a tool_calls object that has the name of the function and the generated function arguments.
 
 import json
+import email.utils
+import time
+import openai
 from openai import OpenAI
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt, stop_before_delay
 from termcolor import colored  
 
 GPT_MODEL = "gpt-4o-mini"
-client = OpenAI()
+client = OpenAI(max_retries=0)  # provider_retry does the retrying, the SDK's own retries would multiply it
 
 # Utilities
 # First let's define a few utilities for making calls to the Chat Completions API and for maintaining and keeping track of the conversation state.
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL):
+# Only transient errors are worth retrying: rate limits, timeouts, dropped connections and server errors. 
+# Bad requests, authentication and permission errors are fatal and fail straight away. 
+# When the provider tells us how long to wait (the Retry-After header) we wait exactly that long, otherwise we back off exponentially with jitter. 
+# All attempts share one deadline.
+
+REQUEST_DEADLINE = 60  # seconds, across all attempts of one request
+
+def is_retryable(exception):
+    if isinstance(exception, openai.APIConnectionError):
+        return True
+    return isinstance(exception, openai.APIStatusError) and (exception.status_code in (408, 409, 429) or exception.status_code >= 500)
+
+def retry_after(exception):
+    """Return the delay in seconds requested by the provider's Retry-After header, if any."""
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
     try:
-        response = client.chat.completions.create(
+        return float(value)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+backoff = wait_random_exponential(multiplier=1, max=40)
+
+def wait_for_provider(retry_state):
+    delay = retry_after(retry_state.outcome.exception())
+    return delay if delay is not None else backoff(retry_state)
+
+provider_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_for_provider,
+    stop=stop_after_attempt(5) | stop_before_delay(REQUEST_DEADLINE),
+    reraise=True,
+)
+
+@provider_retry
+def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL, **kwargs):
+    try:
+        return client.chat.completions.create(
             model=model,
             messages=messages,
             tools=tools,
             tool_choice=tool_choice,
+            **kwargs,
         )
-        return response
     except Exception as e:
         print("Unable to generate ChatCompletion response")
         print(f"Exception: {e}")
-        return e
+        raise
 def convert_message_output_to_dict_format(llm_response):
     return { 
         'role': llm_response.role,
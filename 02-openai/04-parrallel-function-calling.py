@@ -9,30 +9,266 @@
 # as well as a tool_calls object that has the name of the function and the generated function arguments.
 
 import json
+import email.utils
+import threading
+import time
+import openai
 from openai import OpenAI
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt, stop_before_delay
 from termcolor import colored  
 
 GPT_MODEL = "gpt-4o-mini"
-client = OpenAI()
+client = OpenAI(max_retries=0)  # provider_retry does the retrying, the SDK's own retries would multiply it
 
 # Utilities
 # First let's define a few utilities for making calls to the Chat Completions API and for maintaining and keeping track of the conversation state.
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
-def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL):
+# Only transient errors are worth retrying: rate limits, timeouts, dropped connections and server errors. 
+# Bad requests, authentication and permission errors are fatal and fail straight away. 
+# When the provider tells us how long to wait (the Retry-After header) we wait exactly that long, otherwise we back off exponentially with jitter. 
+# All attempts share one deadline, and a circuit breaker fails fast while the provider keeps failing instead of piling more requests onto it.
+
+REQUEST_DEADLINE = 60  # seconds, across all attempts of one request
+
+def is_retryable(exception):
+    if isinstance(exception, openai.APIConnectionError):
+        return True
+    return isinstance(exception, openai.APIStatusError) and (exception.status_code in (408, 409, 429) or exception.status_code >= 500)
+
+def retry_after(exception):
+    """Return the delay in seconds requested by the provider's Retry-After header, if any."""
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+backoff = wait_random_exponential(multiplier=1, max=40)
+
+def wait_for_provider(retry_state):
+    delay = retry_after(retry_state.outcome.exception())
+    return delay if delay is not None else backoff(retry_state)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Stop calling a provider for reset_timeout seconds after failure_threshold consecutive transient failures."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if self.opened_at is None:
+                return self
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"provider unavailable, retry in {self.reset_timeout - (time.monotonic() - self.opened_at):.1f} seconds")
+            # Half open: let this request through as a probe, the others keep failing fast until it reports back
+            self.opened_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exception, traceback):
+        with self.lock:
+            if exception is None or not is_retryable(exception):
+                # The provider answered, even a refused request (e.g. a 400) shows it is up again
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+        return False
+
+circuit_breaker = CircuitBreaker()
+
+provider_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_for_provider,
+    stop=stop_after_attempt(5) | stop_before_delay(REQUEST_DEADLINE),
+    reraise=True,
+)
+
+# Keeping the conversation within budget
+# The messages list grows with every turn, and the tool definitions are sent again on every request, 
+# so long sessions get slower and more expensive. Before each request the budgeter counts the tokens of the messages 
+# and the tools with tiktoken (the same tokenizer the model uses) and, if the prompt is over the model's budget, 
+# drops the oldest turns first. System messages and the latest user turn are always kept, and an assistant message 
+# with tool calls is only ever dropped together with its tool results, since the API rejects one without the other. 
+# Optionally the dropped turns can be replaced by a summary. Every request records how many tokens it saved.
+
+import tiktoken
+
+class ConversationBudgeter:
+    """Trim old turns so each request's prompt fits a per-model token budget."""
+
+    # Every message is wrapped in a few formatting tokens, and the reply is primed with a few more
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_NAME = 1
+    REPLY_PRIMING = 3
+
+    def __init__(self, budgets, default_budget=8_000, summarize=None):
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self.summarize = summarize
+        self.encodings = {}
+        self.tool_tokens = {}
+        self.reports = []
+
+    def encoding(self, model):
+        if model not in self.encodings:
+            try:
+                self.encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encodings[model] = tiktoken.get_encoding("o200k_base")
+        return self.encodings[model]
+
+    def count_message(self, message, model):
+        if hasattr(message, "model_dump"):
+            message = message.model_dump(exclude_none=True)
+        tokens = self.TOKENS_PER_MESSAGE
+        for key, value in message.items():
+            if value is None:
+                continue
+            tokens += len(self.encoding(model).encode(value if isinstance(value, str) else json.dumps(value)))
+            if key == "name":
+                tokens += self.TOKENS_PER_NAME
+        return tokens
+
+    def count_tools(self, tools, model):
+        if not tools:
+            return 0
+        # The same tools list is sent with every request, so count it once (the cache keeps it alive so its id stays unique)
+        key = (id(tools), model)
+        if key not in self.tool_tokens:
+            self.tool_tokens[key] = (tools, len(self.encoding(model).encode(json.dumps(tools))))
+        return self.tool_tokens[key][1]
+
+    def fit(self, messages, tools=None, model=GPT_MODEL):
+        """Return the messages to send, dropping (or summarizing) the oldest turns until the prompt fits the budget."""
+        def role(message):
+            return message["role"] if isinstance(message, dict) else message.role
+
+        budget = self.budgets.get(model, self.default_budget)
+        # Group the messages into turns: a user message together with every reply to it, including tool calls and their results
+        turns = []
+        for message in messages:
+            if turns and role(message) not in ("system", "user") and role(turns[-1][0]) != "system":
+                turns[-1].append(message)
+            else:
+                turns.append([message])
+        counts = [sum(self.count_message(message, model) for message in turn) for turn in turns]
+        tokens_before = self.REPLY_PRIMING + self.count_tools(tools, model) + sum(counts)
+        tokens_after = tokens_before
+        user_turns = [index for index, turn in enumerate(turns) if role(turn[0]) == "user"]
+        latest_turn = user_turns[-1] if user_turns else len(turns) - 1
+        dropped = set()
+        for index in range(latest_turn):
+            if tokens_after <= budget:
+                break
+            if role(turns[index][0]) != "system":
+                dropped.add(index)
+                tokens_after -= counts[index]
+        kept = [message for index, turn in enumerate(turns) if index not in dropped for message in turn]
+        if dropped and self.summarize is not None:
+            summary = {
+                "role": "system",
+                "content": "Summary of the earlier conversation: "
+                + self.summarize([message for index in sorted(dropped) for message in turns[index]]),
+            }
+            leading_system = next((position for position, message in enumerate(kept) if role(message) != "system"), len(kept))
+            kept.insert(leading_system, summary)
+            tokens_after += self.count_message(summary, model)
+        self.reports.append({
+            "model": model,
+            "budget": budget,
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": tokens_before - tokens_after,
+            "messages_dropped": sum(len(turns[index]) for index in dropped),
+        })
+        return kept
+
+conversation_budgeter = ConversationBudgeter(budgets={"gpt-4o-mini": 16_000, "gpt-4o": 16_000})
+
+@provider_retry
+def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL, **kwargs):
+    messages = conversation_budgeter.fit(messages, tools=tools, model=model)
     try:
-        response = client.chat.completions.create(
+        with circuit_breaker:
+            return client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                tool_choice=tool_choice,
+                **kwargs,
+            )
+    except Exception as e:
+        print("Unable to generate ChatCompletion response")
+        print(f"Exception: {e}")
+        raise
+
+# An asyncio server handling hundreds of conversations should not open a connection per request. 
+# All async requests share one AsyncOpenAI client whose HTTP connection pool is tunable: 
+# how many connections may be open, how many idle ones are kept alive and for how long, and whether to use HTTP/2 
+# (HTTP/2 multiplexes many concurrent requests over a single socket; it needs the optional h2 package).
+
+import importlib.util
+import httpx
+from openai import AsyncOpenAI
+
+async_client = None
+
+def create_async_client(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=60.0, http2=None):
+    """Create an AsyncOpenAI client backed by a pooled, keep-alive HTTP client."""
+    if http2 is None:
+        http2 = importlib.util.find_spec("h2") is not None
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=timeout,
+        http2=http2,
+    )
+    return AsyncOpenAI(http_client=http_client, max_retries=0)
+
+def get_async_client():
+    """Return the shared AsyncOpenAI client, creating it with the default pool settings on first use."""
+    global async_client
+    if async_client is None:
+        async_client = create_async_client()
+    return async_client
+
+@provider_retry
+async def async_chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL, **kwargs):
+    messages = conversation_budgeter.fit(messages, tools=tools, model=model)
+    with circuit_breaker:
+        return await get_async_client().chat.completions.create(
             model=model,
             messages=messages,
             tools=tools,
             tool_choice=tool_choice,
+            **kwargs,
         )
-        return response
-    except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
-        return e
+
 def convert_message_output_to_dict_format(llm_response):
     return { 
         'role': llm_response.role,
@@ -70,78 +306,573 @@ def pretty_print_conversation(messages):
                 print(colored(f"function ({message.name}): {message.content}\n", role_to_color[message.role]))
 
         
-def get_current_weather(location, format):
-    import random
-    if format == 'celsius':
-        # Define the temperature range in Celsius
-        min_temp = -89.2
-        max_temp = 56.7
+# Weather forecasts
+# Instead of drawing one random temperature per day in a Python loop, the forecast engine draws the temperatures for 
+# every location and every day of a batch with a single NumPy call. Its random generator can be seeded for reproducible output, 
+# and the results are returned as structured JSON arrays rather than prose, which are cheaper for the model to read.
 
-        # Generate a random floating-point number within the range
-        random_temp = random.uniform(min_temp, max_temp)
-    elif format == 'Fahrenheit':
-                # Define the temperature range in Celsius
-        min_temp = -89.2
-        max_temp = 56.7
+import typing
+import numpy as np
 
-        # Generate a random floating-point number within the range
-        random_temp = random.uniform(min_temp, max_temp)
+class ForecastEngine:
+    """Vectorized temperature forecasts for many locations and days at once."""
 
-    return f'The current weather in {location}: {random_temp} in {format}'
+    MIN_CELSIUS = -89.2
+    MAX_CELSIUS = 56.7
 
-# Let's create some function specifications to interface with a hypothetical weather API. 
-# We'll pass these function specification to the Chat Completions API in order to generate function arguments that adhere to the specification.
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
 
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_weather",
-            "description": "Get the current weather",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "location": {
-                        "type": "string",
-                        "description": "The city and state, e.g. San Francisco, CA",
-                    },
-                    "format": {
-                        "type": "string",
-                        "enum": ["celsius", "fahrenheit"],
-                        "description": "The temperature unit to use. Infer this from the users location.",
-                    },
-                },
-                "required": ["location", "format"],
-            },
+    @staticmethod
+    def validate(request):
+        """Raise ValueError if a single {"location", "format", "num_days"} request can't be forecast."""
+        if not isinstance(request.get("location"), str):
+            raise ValueError("location must be a string")
+        if str(request.get("format", "")).lower() not in ("celsius", "fahrenheit"):
+            raise ValueError(f"format must be celsius or fahrenheit, not {request.get('format')!r}")
+        try:
+            num_days = int(request.get("num_days", 1))
+        except (TypeError, ValueError):
+            raise ValueError(f"num_days must be an integer, not {request.get('num_days')!r}") from None
+        if num_days < 1:
+            raise ValueError("num_days must be at least 1")
+
+    def forecast(self, requests):
+        """Forecast a batch of {"location", "format", "num_days"} requests in one draw."""
+        if len(requests) == 0:
+            return []
+        for request in requests:
+            self.validate(request)
+        num_days = np.array([int(request.get("num_days", 1)) for request in requests])
+        fahrenheit = np.array([request["format"].lower() == "fahrenheit" for request in requests])
+        celsius = self.rng.uniform(self.MIN_CELSIUS, self.MAX_CELSIUS, size=(len(requests), num_days.max()))
+        temperatures = np.round(np.where(fahrenheit[:, None], celsius * 9 / 5 + 32, celsius), 1)
+        return [
+            {"location": request["location"], "format": request["format"], "temperature": row[:days].tolist()}
+            for request, row, days in zip(requests, temperatures, num_days)
+        ]
+
+forecast_engine = ForecastEngine()
+
+def get_current_weather_batch(requests):
+    forecasts = forecast_engine.forecast([dict(request, num_days=1) for request in requests])
+    return [json.dumps(dict(forecast, temperature=forecast["temperature"][0])) for forecast in forecasts]
+
+def get_n_day_weather_forecast_batch(requests):
+    return [json.dumps(forecast) for forecast in forecast_engine.forecast(requests)]
+
+def get_current_weather(location: str, format: typing.Literal["celsius", "fahrenheit"]) -> str:
+    """
+    Get the current weather
+
+    Args:
+        location: The city and state, e.g. San Francisco, CA
+        format: The temperature unit to use. Infer this from the users location.
+    """
+    return get_current_weather_batch([{"location": location, "format": format}])[0]
+
+def get_n_day_weather_forecast(location: str, format: typing.Literal["celsius", "fahrenheit"], num_days: int) -> str:
+    """
+    Get an N-day weather forecast
+
+    Args:
+        location: The city and state, e.g. San Francisco, CA
+        format: The temperature unit to use. Infer this from the users location.
+        num_days: The number of days to forecast
+    """
+    return get_n_day_weather_forecast_batch([{"location": location, "format": format, "num_days": num_days}])[0]
+
+# Caching tool results
+# A parallel-call turn often asks for the same city more than once, and busy periods repeat the same cities across conversations. 
+# Tool results are therefore cached under their normalized arguments (key order, case and extra whitespace do not matter), 
+# each tool with its own time to live, and the least recently used entries are evicted once the cache is full. 
+# Concurrent identical calls are coalesced: the first one runs the tool, the others wait for its result (single-flight). 
+# The hit and miss counters tell us whether the cache is sized well.
+
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class ToolResultCache:
+    """TTL + LRU cache of tool results with single-flight execution of identical concurrent calls."""
+
+    def __init__(self, ttls, max_entries=1024):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def cacheable(self, name):
+        return name in self.ttls
+
+    def key(self, name, arguments):
+        def normalize(value):
+            return " ".join(value.split()).casefold() if isinstance(value, str) else value
+        return name, json.dumps({key: normalize(value) for key, value in arguments.items()}, sort_keys=True)
+
+    def begin(self, name, arguments):
+        """Claim a call. Returns (key, future, owner); only the owner runs the tool and must call finish()."""
+        key = self.key(name, arguments)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(key)
+                future = Future()
+                future.set_result(entry[1])
+                return key, future, False
+            if key in self.in_flight:
+                self.coalesced += 1
+                return key, self.in_flight[key], False
+            self.misses += 1
+            future = Future()
+            self.in_flight[key] = future
+            return key, future, True
+
+    def finish(self, key, future, result=None, error=None):
+        """Store the result of an owned call and hand it (or its error) to everyone waiting on it."""
+        with self.lock:
+            del self.in_flight[key]
+            if error is None:
+                self.entries[key] = (time.monotonic() + self.ttls[key[0]], result)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def call(self, name, function, **arguments):
+        """Run function through the cache from synchronous code."""
+        key, future, owner = self.begin(name, arguments)
+        if owner:
+            try:
+                result = function(**arguments)
+            except Exception as e:
+                self.finish(key, future, error=e)
+                raise
+            self.finish(key, future, result)
+        return future.result()
+
+    def wrap(self, name, function):
+        return functools.partial(self.call, name, function)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else None,
         }
+
+tool_result_cache = ToolResultCache(
+    ttls={
+        "get_current_weather": 5 * 60,
+        "get_n_day_weather_forecast": 30 * 60,
     },
-    {
-        "type": "function",
-        "function": {
-            "name": "get_n_day_weather_forecast",
-            "description": "Get an N-day weather forecast",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "location": {
-                        "type": "string",
-                        "description": "The city and state, e.g. San Francisco, CA",
-                    },
-                    "format": {
-                        "type": "string",
-                        "enum": ["celsius", "fahrenheit"],
-                        "description": "The temperature unit to use. Infer this from the users location.",
-                    },
-                    "num_days": {
-                        "type": "integer",
-                        "description": "The number of days to forecast",
-                    }
-                },
-                "required": ["location", "format", "num_days"]
-            },
+)
+
+# Let's create some function specifications to interface with a hypothetical weather API. 
+# We'll pass these function specification to the Chat Completions API in order to generate function arguments that adhere to the specification.
+# Rather than writing the JSON by hand, the tool registry derives each specification once from the function's type hints 
+# and its Google-style docstring (the summary becomes the description, the Args section the parameter descriptions). 
+# The payload is built once and reused, so no turn has to rebuild the schemas.
+
+import inspect
+import re
+import types
+import typing
+
+JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", list: "array", dict: "object"}
+
+def parse_docstring(docstring, parameter_names):
+    """Split a Google-style docstring into its summary and a description per argument."""
+    summary = []
+    descriptions = {}
+    section = None
+    name = None
+    for line in inspect.cleandoc(docstring or "").splitlines():
+        stripped = line.strip()
+        if stripped.lower() in ("args:", "arguments:", "parameters:"):
+            section = "args"
+        elif re.match(r"^(returns|yields|raises|examples?|notes?):$", stripped.lower()):
+            section = "other"
+        elif section is None and stripped:
+            summary.append(stripped)
+        elif section == "args" and stripped:
+            match = re.match(r"^(\w+)\s*(?:\([^)]*\))?\s*:\s*(.*)$", stripped)
+            if match and match.group(1) in parameter_names:
+                name = match.group(1)
+                descriptions[name] = match.group(2)
+            elif name is not None:
+                descriptions[name] += " " + stripped
+    return " ".join(summary), descriptions
+
+def json_schema(annotation):
+    """Translate a type hint into a JSON schema."""
+    origin = typing.get_origin(annotation)
+    arguments = typing.get_args(annotation)
+    if origin is typing.Literal:
+        return {"type": JSON_TYPES[type(arguments[0])], "enum": list(arguments)}
+    if origin in (typing.Union, types.UnionType):
+        options = [argument for argument in arguments if argument is not type(None)]
+        if len(options) == 1:
+            return json_schema(options[0])
+        return {"anyOf": [json_schema(option) for option in options]}
+    if origin in (list, tuple, set):
+        return {"type": "array", "items": json_schema(arguments[0])} if arguments else {"type": "array"}
+    if origin is dict:
+        return {"type": "object"}
+    return {"type": JSON_TYPES.get(annotation, "string")}
+
+def function_schema(function):
+    """Build the function specification of a tool from its signature and docstring."""
+    signature = inspect.signature(function)
+    hints = typing.get_type_hints(function)
+    description, descriptions = parse_docstring(function.__doc__, signature.parameters)
+    properties = {}
+    required = []
+    for name, parameter in signature.parameters.items():
+        annotation = hints.get(name, str)
+        properties[name] = json_schema(annotation)
+        if name in descriptions:
+            properties[name]["description"] = descriptions[name]
+        optional = type(None) in typing.get_args(annotation)
+        if parameter.default is inspect.Parameter.empty and not optional:
+            required.append(name)
+    return {
+        "name": function.__name__,
+        "description": description,
+        "parameters": {"type": "object", "properties": properties, "required": required},
+    }
+
+class ToolRegistry:
+    """Tool specifications derived once from Python functions, with the tools payload prebuilt for the Chat Completions API."""
+
+    def __init__(self):
+        self.functions = {}
+        self.schemas = {}
+        self.tools = None
+
+    def register(self, function):
+        """Register a function as a tool. Can be used as a decorator."""
+        self.functions[function.__name__] = function
+        self.schemas[function.__name__] = function_schema(function)
+        self.tools = None
+        return function
+
+    def payload(self):
+        """Return the prebuilt tools payload."""
+        if self.tools is None:
+            self.tools = [{"type": "function", "function": schema} for schema in self.schemas.values()]
+        return self.tools
+
+tool_registry = ToolRegistry()
+tool_registry.register(get_current_weather)
+tool_registry.register(get_n_day_weather_forecast)
+
+tools = tool_registry.payload()
+
+names_to_functions = {
+    'get_current_weather': tool_result_cache.wrap('get_current_weather', get_current_weather),
+    'get_n_day_weather_forecast': tool_result_cache.wrap('get_n_day_weather_forecast', get_n_day_weather_forecast),
+}
+
+# Streaming tool calls
+# Normally we only see the tool calls once the whole assistant message has arrived, so no tool can start before the model finishes writing the last one. 
+# When streaming, the arguments of every tool call arrive as small deltas tagged with the index of the call they belong to. 
+# We accumulate them per index and try to parse them as they grow (jiter can also parse the partial JSON, which is handy for showing progress). 
+# As soon as the arguments of a call form a complete JSON object we hand the call to a thread pool, 
+# so tool execution overlaps with the generation of the remaining tool calls.
+
+import jiter
+from concurrent.futures import ThreadPoolExecutor
+
+stream = True
+
+class StreamingToolCallAssembler:
+    """Assemble streamed tool-call deltas and dispatch each call as soon as its arguments are complete."""
+
+    def __init__(self, functions, executor):
+        self.functions = functions
+        self.executor = executor
+        self.calls = {}
+        self.futures = {}
+
+    def add(self, tool_call_deltas):
+        for delta in tool_call_deltas:
+            call = self.calls.setdefault(delta.index, {"id": None, "name": "", "arguments": ""})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function.name:
+                call["name"] += delta.function.name
+            if delta.function.arguments:
+                call["arguments"] += delta.function.arguments
+                self.dispatch_if_complete(delta.index)
+
+    def partial_arguments(self, index):
+        """Return the arguments generated so far for the tool call at index, parsed from partial JSON."""
+        arguments = self.calls[index]["arguments"]
+        return jiter.from_json(arguments.encode(), partial_mode="trailing-strings") if arguments else {}
+
+    def dispatch_if_complete(self, index):
+        call = self.calls[index]
+        if index in self.futures or not call["arguments"].rstrip().endswith("}"):
+            return
+        try:
+            arguments = jiter.from_json(call["arguments"].encode())
+        except ValueError:
+            # The closing brace belonged to a nested object or a string, keep accumulating
+            return
+        self.futures[index] = self.executor.submit(self.execute, call["name"], arguments)
+
+    def execute(self, name, arguments):
+        if name not in self.functions:
+            return json.dumps({"error": f"function {name} does not exist"})
+        if isinstance(arguments, str):
+            try:
+                arguments = jiter.from_json(arguments.encode())
+            except ValueError as e:
+                return json.dumps({"error": f"invalid arguments for {name}: {e}"})
+        try:
+            return str(self.functions[name](**arguments))
+        except Exception as e:
+            return json.dumps({"error": f"function {name} failed with error: {e}"})
+
+    def finish(self):
+        """Wait for every dispatched call and return the assistant message and the tool messages, in call order."""
+        for index, call in self.calls.items():
+            if index not in self.futures:
+                # Calls without arguments, or whose arguments never parsed, are executed (or rejected) now
+                self.futures[index] = self.executor.submit(self.execute, call["name"], call["arguments"] or "{}")
+        ordered = sorted(self.calls)
+        assistant_message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": self.calls[index]["id"],
+                    "type": "function",
+                    "function": {"name": self.calls[index]["name"], "arguments": self.calls[index]["arguments"]},
+                }
+                for index in ordered
+            ],
         }
-    },
-]
+        tool_messages = [
+            {
+                "role": "tool",
+                "tool_call_id": self.calls[index]["id"],
+                "name": self.calls[index]["name"],
+                "content": self.futures[index].result(),
+            }
+            for index in ordered
+        ]
+        return assistant_message, tool_messages
+
+def stream_chat_completion_with_tools(messages, tools, functions, tool_choice=None, model=GPT_MODEL):
+    """Stream a chat completion, executing tool calls while the rest of the response is generated."""
+    with ThreadPoolExecutor() as executor:
+        assembler = StreamingToolCallAssembler(functions, executor)
+        content = ""
+        response = chat_completion_request(messages, tools=tools, tool_choice=tool_choice, model=model, stream=True)
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content += delta.content
+            if delta.tool_calls:
+                assembler.add(delta.tool_calls)
+        if not assembler.calls:
+            return {"role": "assistant", "content": content}, []
+        assistant_message, tool_messages = assembler.finish()
+    assistant_message["content"] = content or None
+    return assistant_message, tool_messages
+
+# Executing parallel tool calls
+# A parallel-call turn can contain many tool calls. Running them one after the other makes the turn as slow as the sum of all tools; 
+# running them concurrently makes it as slow as the slowest one. 
+# Coroutine tools (I/O-bound, e.g. HTTP APIs) run directly on an asyncio event loop, blocking tools run in a thread pool 
+# and CPU-bound tools in a process pool (process tools must be importable module-level functions so they can be pickled). 
+# Every tool gets its own timeout, and the tool messages are returned in the same order as the tool calls.
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+class ToolExecutor:
+    """Run all tool calls of a turn concurrently, with a timeout per tool."""
+
+    def __init__(self, max_workers=None, cache=None):
+        self.tools = {}
+        self.thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.process_pool = None
+        self.max_workers = max_workers
+        self.cache = cache
+
+    def register(self, name, function, kind="thread", timeout=10.0, batch=None, validate=None):
+        """Register a tool. kind is "async" for coroutine functions, "thread" for blocking I/O or "process" for CPU-bound work.
+
+        If batch is given, every call of the tool in a turn is served by a single batch(list_of_arguments) call,
+        which must return one result per set of arguments.
+        If validate is given, it is called with the arguments of each call and raises ValueError for invalid ones,
+        so a bad call gets its own error instead of failing the whole batch.
+        """
+        if kind not in ("async", "thread", "process"):
+            raise ValueError(f"unknown tool kind: {kind}")
+        self.tools[name] = {"function": function, "kind": kind, "timeout": timeout, "batch": batch, "validate": validate}
+
+    def pool(self, kind):
+        if kind == "process":
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self.process_pool
+        return self.thread_pool
+
+    async def call(self, name, function, *args, **kwargs):
+        """Run function the way the tool's kind asks for, under the tool's timeout."""
+        tool = self.tools[name]
+        if tool["kind"] == "async":
+            pending = function(*args, **kwargs)
+        else:
+            pending = asyncio.get_running_loop().run_in_executor(
+                self.pool(tool["kind"]), functools.partial(function, *args, **kwargs)
+            )
+        # A timed out thread keeps running in the background, but the turn no longer waits for it
+        return await asyncio.wait_for(pending, timeout=tool["timeout"])
+
+    async def cached_call(self, name, arguments, run):
+        """Await run() through the result cache, or directly when the tool is not cached."""
+        if self.cache is None or not self.cache.cacheable(name):
+            return await run()
+        key, future, owner = self.cache.begin(name, arguments)
+        if owner:
+            try:
+                result = await run()
+            except BaseException as e:
+                self.cache.finish(key, future, error=e)
+            else:
+                self.cache.finish(key, future, result)
+        return await asyncio.wrap_future(future)
+
+    def parse_arguments(self, name, arguments):
+        """Parse the JSON arguments of one call and check them against the tool, raising ValueError or TypeError if they don't fit."""
+        tool = self.tools[name]
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments or "{}")
+        if not isinstance(arguments, dict):
+            raise TypeError("arguments must be a JSON object")
+        inspect.signature(tool["function"]).bind(**arguments)
+        if tool["validate"] is not None:
+            tool["validate"](arguments)
+        return arguments
+
+    async def execute(self, name, arguments):
+        if name not in self.tools:
+            return json.dumps({"error": f"function {name} does not exist"})
+        try:
+            arguments = self.parse_arguments(name, arguments)
+        except (ValueError, TypeError) as e:
+            return json.dumps({"error": f"invalid arguments for {name}: {e}"})
+        try:
+            async def run():
+                return str(await self.call(name, self.tools[name]["function"], **arguments))
+            return await self.cached_call(name, arguments, run)
+        except asyncio.TimeoutError:
+            return json.dumps({"error": f"function {name} timed out after {self.tools[name]['timeout']} seconds"})
+        except Exception as e:
+            return json.dumps({"error": f"function {name} failed with error: {e}"})
+
+    async def execute_batch(self, name, arguments_list):
+        """Serve the calls of a batched tool with one batch call. Calls with invalid arguments get their own error and stay out of the batch."""
+        results = [None] * len(arguments_list)
+        valid = []
+        for position, arguments in enumerate(arguments_list):
+            try:
+                valid.append((position, self.parse_arguments(name, arguments)))
+            except (ValueError, TypeError) as e:
+                results[position] = json.dumps({"error": f"invalid arguments for {name}: {e}"})
+        if valid:
+            batch_results = await self.run_batch(name, [arguments for _, arguments in valid])
+            for (position, _), result in zip(valid, batch_results):
+                results[position] = result
+        return results
+
+    async def run_batch(self, name, arguments_list):
+        try:
+            if self.cache is None or not self.cache.cacheable(name):
+                return [str(result) for result in await self.call(name, self.tools[name]["batch"], arguments_list)]
+            # Cached and in-flight calls are served from the cache, only the remaining ones go into the batch
+            claims = [self.cache.begin(name, arguments) for arguments in arguments_list]
+            owned = [(claim, arguments) for claim, arguments in zip(claims, arguments_list) if claim[2]]
+            if owned:
+                try:
+                    results = await self.call(name, self.tools[name]["batch"], [arguments for _, arguments in owned])
+                except BaseException as e:
+                    for (key, future, _), _ in owned:
+                        self.cache.finish(key, future, error=e)
+                    raise
+                for ((key, future, _), _), result in zip(owned, results):
+                    self.cache.finish(key, future, str(result))
+            return list(await asyncio.gather(*(asyncio.wrap_future(future) for _, future, _ in claims)))
+        except asyncio.TimeoutError:
+            return [json.dumps({"error": f"function {name} timed out after {self.tools[name]['timeout']} seconds"})] * len(arguments_list)
+        except Exception as e:
+            return [json.dumps({"error": f"function {name} failed with error: {e}"})] * len(arguments_list)
+
+    async def run(self, tool_calls):
+        """Execute the tool calls concurrently and return one tool message per call, in call order."""
+        batches = {}
+        single_positions = []
+        for position, tool_call in enumerate(tool_calls):
+            tool = self.tools.get(tool_call.function.name)
+            if tool is not None and tool["batch"] is not None:
+                batches.setdefault(tool_call.function.name, []).append(position)
+            else:
+                single_positions.append(position)
+        outcomes = await asyncio.gather(
+            *(self.execute(tool_calls[position].function.name, tool_calls[position].function.arguments) for position in single_positions),
+            *(self.execute_batch(name, [tool_calls[position].function.arguments for position in positions]) for name, positions in batches.items()),
+        )
+        results = [None] * len(tool_calls)
+        for position, result in zip(single_positions, outcomes):
+            results[position] = result
+        for positions, batch_results in zip(batches.values(), outcomes[len(single_positions):]):
+            for position, result in zip(positions, batch_results):
+                results[position] = result
+        return [
+            {
+                "role": "tool",
+                "tool_call_id": tool_call.id,
+                "name": tool_call.function.name,
+                "content": result,
+            }
+            for tool_call, result in zip(tool_calls, results)
+        ]
+
+    def run_sync(self, tool_calls):
+        """Execute the tool calls from synchronous code."""
+        return asyncio.run(self.run(tool_calls))
+
+    def shutdown(self):
+        self.thread_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+tool_executor = ToolExecutor(cache=tool_result_cache)
+# All forecasts requested in one turn come out of a single vectorized draw
+tool_executor.register("get_current_weather", get_current_weather, timeout=5.0, batch=get_current_weather_batch, validate=forecast_engine.validate)
+tool_executor.register("get_n_day_weather_forecast", get_n_day_weather_forecast, timeout=5.0, batch=get_n_day_weather_forecast_batch, validate=forecast_engine.validate)
 
 # Parallel Function Calling
 # Newer models such as gpt-4o or gpt-3.5-turbo can call multiple functions in one turn
@@ -159,10 +890,69 @@ messages.append(
         "content": "what is the weather going to be like in San Francisco and Glasgow over the next 4 days"
     }
 )
-chat_response = chat_completion_request(
-    messages, tools=tools, model=GPT_MODEL
-)
 
-assistant_message = chat_response.choices[0].message.tool_calls
-print(f'LLS Response:\n\n{assistant_message}\n\n')
+if stream:
+    # Each forecast starts running as soon as its arguments have been generated, while the model is still writing the next call
+    assistant_message, tool_messages = stream_chat_completion_with_tools(
+        messages, tools=tools, functions=names_to_functions, model=GPT_MODEL
+    )
+    print(f'LLS Response:\n\n{assistant_message}\n\n')
+    messages.append(assistant_message)
+    messages.extend(tool_messages)
+    for tool_message in tool_messages:
+        print(f'Function Execution Result ({tool_message["name"]}):\n{tool_message["content"]}\n')
+else:
+    chat_response = chat_completion_request(
+        messages, tools=tools, model=GPT_MODEL
+    )
+
+    assistant_message = chat_response.choices[0].message
+    print(f'LLS Response:\n\n{assistant_message.tool_calls}\n\n')
+    messages.append(assistant_message)
+    # Run the forecasts for San Francisco and Glasgow at the same time
+    tool_messages = tool_executor.run_sync(assistant_message.tool_calls or [])
+    messages.extend(tool_messages)
+    for tool_message in tool_messages:
+        print(f'Function Execution Result ({tool_message["name"]}):\n{tool_message["content"]}\n')
 pretty_print_conversation(messages=messages)
+
+# Many conversations at once
+# With the async client, independent conversations run concurrently and share the same pooled connections. 
+# Here each city gets its own conversation, and the tool calls of every conversation run on the tool executor.
+
+async def answer_question(question):
+    messages = [
+        {
+            "role": "system", 
+            "content": "Don't make assumptions about what values to plug into functions. Ask for clarification if a user request is ambiguous."
+        },
+        {"role": "user", "content": question},
+    ]
+    chat_response = await async_chat_completion_request(messages, tools=tools)
+    assistant_message = chat_response.choices[0].message
+    messages.append(assistant_message)
+    if not assistant_message.tool_calls:
+        return assistant_message.content
+    messages.extend(await tool_executor.run(assistant_message.tool_calls))
+    chat_response = await async_chat_completion_request(messages)
+    return chat_response.choices[0].message.content
+
+async def answer_questions(questions):
+    global async_client
+    try:
+        return await asyncio.gather(*(answer_question(question) for question in questions))
+    finally:
+        await get_async_client().close()
+        # The client's connections belong to this event loop, so a later get_async_client() must create a new one
+        async_client = None
+
+print('\n\nCONCURRENT CONVERSATIONS\n\n')
+answers = asyncio.run(answer_questions([
+    "what is the weather going to be like in San Francisco, CA over the next 4 days in fahrenheit",
+    "what is the weather going to be like in Glasgow, Scotland over the next 4 days in celsius",
+]))
+for answer in answers:
+    print(f'{answer}\n')
+print(f'Tool result cache: {tool_result_cache.stats()}\n')
+print(f'Tokens saved per request: {[report["tokens_saved"] for report in conversation_budgeter.reports]}\n')
+tool_executor.shutdown()
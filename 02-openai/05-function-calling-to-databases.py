@@ -1,81 +1,1824 @@
 import sqlite3
 import json 
+import time
+import email.utils
+import threading
+import openai
 from openai import OpenAI
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt, stop_before_delay
 
 GPT_MODEL = "gpt-4o-mini"
-client = OpenAI()
+client = OpenAI(max_retries=0)  # provider_retry does the retrying, the SDK's own retries would multiply it
 
-conn = sqlite3.connect("02-openai/Chinook.db")
-print("Opened database successfully")
+# Only transient errors are worth retrying: rate limits, timeouts, dropped connections and server errors. 
+# Bad requests, authentication and permission errors are fatal and fail straight away. 
+# When the provider tells us how long to wait (the Retry-After header) we wait exactly that long, otherwise we back off exponentially with jitter. 
+# All attempts share one deadline, and a circuit breaker fails fast while the provider keeps failing instead of piling more requests onto it.
 
-def get_table_names(conn):
-    """Return a list of table names."""
-    table_names = []
-    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for table in tables.fetchall():
-        table_names.append(table[0])
-    return table_names
+REQUEST_DEADLINE = 60  # seconds, across all attempts of one request
 
+def is_retryable(exception):
+    if isinstance(exception, openai.APIConnectionError):
+        return True
+    return isinstance(exception, openai.APIStatusError) and (exception.status_code in (408, 409, 429) or exception.status_code >= 500)
 
-def get_column_names(conn, table_name):
-    """Return a list of column names."""
-    column_names = []
-    columns = conn.execute(f"PRAGMA table_info('{table_name}');").fetchall()
-    for col in columns:
-        column_names.append(col[1])
-    return column_names
+def retry_after(exception):
+    """Return the delay in seconds requested by the provider's Retry-After header, if any."""
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    if "retry-after-ms" in response.headers:
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        # Retry-After may also be an HTTP date
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
 
+backoff = wait_random_exponential(multiplier=1, max=40)
 
-def get_database_info(conn):
-    """Return a list of dicts containing the table name and columns for each table in the database."""
-    table_dicts = []
-    for table_name in get_table_names(conn):
-        columns_names = get_column_names(conn, table_name)
-        table_dicts.append({"table_name": table_name, "column_names": columns_names})
-    return table_dicts
-
-database_schema_dict = get_database_info(conn)
-
-database_schema_string = "\n".join(
-    [
-        f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
-        for table in database_schema_dict
-    ]
+def wait_for_provider(retry_state):
+    delay = retry_after(retry_state.outcome.exception())
+    return delay if delay is not None else backoff(retry_state)
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Stop calling a provider for reset_timeout seconds after failure_threshold consecutive transient failures."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            if self.opened_at is None:
+                return self
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"provider unavailable, retry in {self.reset_timeout - (time.monotonic() - self.opened_at):.1f} seconds")
+            # Half open: let this request through as a probe, the others keep failing fast until it reports back
+            self.opened_at = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exception, traceback):
+        with self.lock:
+            if exception is None or not is_retryable(exception):
+                # The provider answered, even a refused request (e.g. a 400) shows it is up again
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+        return False
+
+circuit_breaker = CircuitBreaker()
+
+provider_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_for_provider,
+    stop=stop_after_attempt(5) | stop_before_delay(REQUEST_DEADLINE),
+    reraise=True,
 )
 
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "ask_database",
-            "description": "Use this function to answer user questions about music. Input should be a fully formed SQL query.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "query": {
-                        "type": "string",
-                        "description": f"""
+# Caching completions
+# Regression suites and FAQ-style questions replay the same prompts over and over, and each replay pays the full provider latency and cost. 
+# Setting COMPLETION_CACHE_PATH turns on a disk-backed completion cache. Requests are keyed on a hash of the canonical JSON 
+# of the model, messages, tools and tool_choice, and the responses are kept in SQLite. SQLite's locking (in WAL mode) makes the cache 
+# safe to share between processes, and once it holds more than max_entries responses the least recently used ones are evicted. 
+# Streamed requests are never cached.
+
+import hashlib
+import os
+from openai.types.chat import ChatCompletion
+
+class CompletionCache:
+    """SQLite-backed, size-bounded LRU cache of chat completions."""
+
+    def __init__(self, path, max_entries=10_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        with self.connection() as cache_conn:
+            cache_conn.execute("PRAGMA journal_mode=WAL")
+            cache_conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, response TEXT NOT NULL, last_used REAL NOT NULL)"
+            )
+            cache_conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, so every thread opens its own
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.path, timeout=30)
+        return self.local.conn
+
+    def key(self, **request):
+        def canonical(value):
+            if hasattr(value, "model_dump"):
+                return value.model_dump(exclude_none=True)
+            raise TypeError(f"can't cache a request containing {type(value).__name__}")
+        payload = json.dumps(request, sort_keys=True, separators=(",", ":"), default=canonical)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.connection() as cache_conn:
+            row = cache_conn.execute("SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                cache_conn.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return None if row is None else row[0]
+
+    def put(self, key, response):
+        with self.connection() as cache_conn:
+            cache_conn.execute(
+                "INSERT OR REPLACE INTO completions (key, response, last_used) VALUES (?, ?, ?)", (key, response, time.time())
+            )
+            cache_conn.execute(
+                "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+completion_cache = CompletionCache(os.environ["COMPLETION_CACHE_PATH"]) if os.environ.get("COMPLETION_CACHE_PATH") else None
+
+@provider_retry
+def chat_completion_request(messages, tools=None, tool_choice=None, model=GPT_MODEL, **kwargs):
+    cache_key = None
+    if completion_cache is not None and not kwargs.get("stream"):
+        cache_key = completion_cache.key(model=model, messages=messages, tools=tools, tool_choice=tool_choice, **kwargs)
+        cached = completion_cache.get(cache_key)
+        if cached is not None:
+            return ChatCompletion.model_validate_json(cached)
+    try:
+        with circuit_breaker:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                tool_choice=tool_choice,
+                **kwargs,
+            )
+    except Exception as e:
+        print("Unable to generate ChatCompletion response")
+        print(f"Exception: {e}")
+        raise
+    if cache_key is not None:
+        completion_cache.put(cache_key, response.model_dump_json())
+    return response
+
+# A pool of read-only connections
+# A sqlite3 connection can't be shared between threads, so with one module-global connection concurrent conversations would queue up on it. 
+# Instead every worker checks a connection out of a pool, uses it on its own and hands it back. 
+# The connections are opened read-only through a URI, but mode=ro only covers the main database file: ATTACH could still create and 
+# write other files, and a PRAGMA set by one query would stay on the pooled connection for every later conversation. So each connection 
+# also turns on query_only, allows no attached databases and gets an authorizer that only lets through reads and a few read-only pragmas. 
+# The database file is switched to WAL mode once, which lets readers run without blocking each other, and each connection memory-maps 
+# the file and gets a larger page cache so repeated queries are served from memory.
+
+import functools
+import queue
+import re
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+DATABASE_PATH = "02-openai/Chinook.db"
+
+READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+READ_PRAGMAS = {"schema_version", "data_version", "table_info", "foreign_key_list"}
+
+def read_only_authorizer(action, arg1, arg2, database, trigger):
+    """SQLite authorizer that denies everything except reads and the pragmas used to inspect the schema."""
+    if action in READ_ACTIONS:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_UPDATE and arg1 in ("sqlite_master", "sqlite_temp_master"):
+        return sqlite3.SQLITE_OK  # reported while SQLite (re)loads the schema; query_only still rejects any real write
+    if action == sqlite3.SQLITE_PRAGMA and arg1.lower() in READ_PRAGMAS and (arg2 is None or arg1.lower() in ("table_info", "foreign_key_list")):
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+def restrict_to_reads(conn):
+    """Lock a read-only connection down so no statement run on it can write anything or change its settings."""
+    conn.execute("PRAGMA query_only=ON;")
+    conn.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, 0)
+    conn.set_authorizer(read_only_authorizer)
+    return conn
+
+class ConnectionPool:
+    """A pool of read-only SQLite connections. Each connection is used by one worker at a time."""
+
+    def __init__(self, path, max_connections=8, mmap_size=256 * 1024 * 1024, cache_size=-64 * 1024, cached_statements=256):
+        self.uri = Path(path).resolve().as_uri()
+        self.max_connections = max_connections
+        self.cached_statements = cached_statements
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size  # negative values are in KiB, as in PRAGMA cache_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._enable_wal()
+
+    def _enable_wal(self):
+        # The journal mode is stored in the database file, so it has to be set once through a writable connection
+        try:
+            with closing(sqlite3.connect(f"{self.uri}?mode=rw", uri=True)) as conn:
+                conn.execute("PRAGMA journal_mode=WAL;")
+        except sqlite3.Error:
+            pass  # e.g. a read-only file system: the read-only connections still work in the existing journal mode
+
+    def connect(self):
+        """Open a new read-only connection. Connections handed out by connection() are opened through this method."""
+        # check_same_thread is off because a pooled connection moves between threads, but never is used by two at once
+        conn = sqlite3.connect(f"{self.uri}?mode=ro", uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size};")
+        conn.execute(f"PRAGMA cache_size={self.cache_size};")
+        return restrict_to_reads(conn)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.max_connections
+            if create:
+                self._created += 1
+        if not create:
+            # Every connection is in use, wait for one to be handed back
+            return self._idle.get()
+        try:
+            return self.connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def connection(self):
+        """Check a connection out of the pool for the duration of the with block."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+database_pool = ConnectionPool(DATABASE_PATH)
+print("Opened database successfully")
+
+# Introspecting the schema
+# Listing the tables and then running one PRAGMA table_info per table costs one query per table, which adds up on databases 
+# with hundreds of tables. Instead we read every table and its columns in a single query through the pragma_table_info table-valued function. 
+# The result is cached in a JSON file next to the database together with PRAGMA schema_version, which SQLite bumps on every schema change. 
+# On the next start we only read schema_version, and reuse the cached schema text and tool definition unless the schema actually changed.
+
+SCHEMA_CACHE_PATH = DATABASE_PATH + ".schema.json"
+SCHEMA_CACHE_FORMAT = 5  # bump when get_database_info, get_schema_string or get_tools change, so stale cache files are rebuilt
+SAMPLE_ROWS = 3  # rows per table whose short text values are kept for schema linking
+
+def get_database_info(conn):
+    """Return a list of dicts containing the table name, columns, foreign keys and sample values for each table in the database."""
+    tables = {}
+    rows = conn.execute(
+        "SELECT m.name, p.name FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p "
+        "WHERE m.type = 'table' AND m.name NOT LIKE 'mv\\_%' ESCAPE '\\' ORDER BY m.rowid, p.cid;"
+    )
+    for table_name, column_name in rows:
+        table = tables.setdefault(table_name, {"table_name": table_name, "column_names": [], "foreign_keys": [], "sample_values": []})
+        table["column_names"].append(column_name)
+    rows = conn.execute(
+        'SELECT m.name, f."from", f."table", f."to" FROM sqlite_master AS m JOIN pragma_foreign_key_list(m.name) AS f '
+        "WHERE m.type = 'table' AND m.name NOT LIKE 'mv\\_%' ESCAPE '\\';"
+    )
+    for table_name, column_name, parent_table, parent_column in rows:
+        tables[table_name]["foreign_keys"].append([column_name, parent_table, parent_column])
+    for table_name, table in tables.items():
+        # Sampling needs one query per table, but like the rest of the schema it only runs when the schema changed
+        name = table_name.replace('"', '""')
+        for row in conn.execute(f'SELECT * FROM "{name}" LIMIT {SAMPLE_ROWS};'):
+            table["sample_values"] += [value for value in row if isinstance(value, str) and len(value) <= 40]
+    return list(tables.values())
+
+
+def get_schema_string(database_schema_dict):
+    """Return the compact schema description embedded in the tool definition."""
+    return "\n".join(
+        [
+            f"Table: {table['table_name']}\nColumns: {', '.join(table['column_names'])}"
+            for table in database_schema_dict
+        ]
+    )
+
+
+def get_tools(database_schema_string):
+    """Return the ask_database tool definition for a schema description."""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": "ask_database",
+                "description": "Use this function to answer user questions about music. Input should be a fully formed SQL query.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {
+                            "type": "string",
+                            "description": f"""
                                 SQL query extracting info to answer the user's question.
                                 SQL should be written using this database schema:
                                 {database_schema_string}
                                 The query should be returned in plain text, not in JSON.
                                 """,
-                    }
+                        },
+                        "cursor": {
+                            "type": "string",
+                            "description": "Continuation cursor returned by a previous ask_database call. Pass it together with the same query to fetch the next page of results.",
+                        },
+                        "format": {
+                            "type": "string",
+                            "enum": ["rows", "summary"],
+                            "description": "rows (the default) returns the result rows page by page. summary returns the row count, statistics for every column and the first rows; use it for large results.",
+                        },
+                    },
+                    "required": ["query"],
                 },
-                "required": ["query"],
-            },
+            }
         }
+    ]
+
+
+def load_schema(conn, cache_path=SCHEMA_CACHE_PATH):
+    """Return the database schema, introspecting the database only when PRAGMA schema_version has changed."""
+    schema_version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+    try:
+        with open(cache_path) as cache_file:
+            schema = json.load(cache_file)
+        if schema["format"] == SCHEMA_CACHE_FORMAT and schema["schema_version"] == schema_version:
+            return schema
+    except (OSError, ValueError, KeyError):
+        pass
+    database_schema_dict = get_database_info(conn)
+    database_schema_string = get_schema_string(database_schema_dict)
+    schema = {
+        "format": SCHEMA_CACHE_FORMAT,
+        "schema_version": schema_version,
+        "tables": database_schema_dict,
+        "schema_string": database_schema_string,
+        "tools": get_tools(database_schema_string),
     }
-]
+    # Write to a temporary file first so a concurrent reader never sees half a cache file
+    with open(cache_path + ".tmp", "w") as cache_file:
+        json.dump(schema, cache_file)
+    os.replace(cache_path + ".tmp", cache_path)
+    return schema
+
+with database_pool.connection() as conn:
+    schema = load_schema(conn)
+database_schema_dict = schema["tables"]
+database_schema_string = schema["schema_string"]
+tools = schema["tools"]
+
+
+# Bounded, paginated results
+# A careless query such as SELECT * FROM InvoiceLine would pull every row into memory and send a huge string back into the prompt. 
+# Instead we read the rows with fetchmany and stop at a row limit and a byte limit, whichever comes first. 
+# The page is written as a header line with the column names followed by tab separated rows, which costs far fewer tokens than the repr of a list of tuples. 
+# When more rows are left we return a continuation cursor the model can pass back to read the next page. 
+# The continuation cursor carries a fingerprint of the query and the row offset: the next page re-runs the query and skips the rows already seen. 
+# We don't keep the SQLite cursor open between pages, because a half-read statement holds its read transaction open: every later query on 
+# that pooled connection would see the old snapshot, and WAL checkpoints would stall while it is parked. 
+# A continuation cursor passed with a different query is rejected rather than skipping rows of an unrelated result.
+
+import hashlib
+
+PAGE_ROWS = 50  # maximum number of rows in one page
+PAGE_BYTES = 4096  # maximum size of one page, in bytes of UTF-8 text
+
+def format_value(value):
+    """Format one column value for a tab separated row."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def query_fingerprint(query, parameters=()):
+    """Return a short fingerprint of a query and its parameters, to tie a continuation cursor to the query it was issued for."""
+    text = json.dumps([query, parameters], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:12]
 
 
-def ask_database(conn, query):
+def cursor_offset(query, cursor=None, parameters=()):
+    """Return the row offset a continuation cursor resumes at, or raise QueryRejected if it was issued for another query."""
+    if not cursor:
+        return 0
+    fingerprint, _, offset = cursor.rpartition(":")
+    if fingerprint != query_fingerprint(query, parameters) or not offset.isdigit():
+        raise QueryRejected(
+            "invalid_cursor",
+            "the cursor does not belong to this query",
+            "pass the exact query the cursor was returned for, or leave the cursor out to start from the first row",
+        )
+    return int(offset)
+
+
+def fetch_page(conn, query, cursor=None, max_rows=PAGE_ROWS, max_bytes=PAGE_BYTES, parameters=()):
+    """Run a SQL query on a connection and return one bounded page of results. Errors are raised to the caller."""
+    offset = cursor_offset(query, cursor, parameters)
+    with closing(conn.execute(query, parameters)) as db_cursor:
+        if db_cursor.description is None:
+            return "query returned no rows"
+        skipped = 0
+        while skipped < offset:
+            rows = db_cursor.fetchmany(min(offset - skipped, 1000))
+            if not rows:
+                break
+            skipped += len(rows)
+        header = "\t".join(column[0] for column in db_cursor.description)
+        lines = [header]
+        size = len(header.encode())
+        # Read one row more than the page needs, so we know whether another page follows
+        rows = db_cursor.fetchmany(max_rows + 1)
+    # Closing the cursor resets the statement, which ends its read transaction
+    shown = 0
+    for row in rows[:max_rows]:
+        line = "\t".join(map(format_value, row))
+        line_size = len(line.encode()) + 1
+        if shown and size + line_size > max_bytes:
+            break
+        if line_size > max_bytes:
+            # A single oversized row is cut rather than dropped, so every page makes progress
+            line = line.encode()[:max_bytes].decode(errors="ignore") + "..."
+            line_size = max_bytes
+        lines.append(line)
+        size += line_size
+        shown += 1
+    end = skipped + shown
+    if shown < len(rows):
+        token = f"{query_fingerprint(query, parameters)}:{end}"
+        lines.append(f'-- rows {skipped + 1}-{end} shown, more rows available: call ask_database again with the same query and cursor "{token}"')
+    else:
+        lines.append(f"-- {end} rows in total")
+    return "\n".join(lines)
+
+
+# Guarding generated SQL
+# The SQL passed into ask_database is whatever the model writes, and one bad cross join can pin a core for minutes. 
+# Before running a query we ask SQLite for its plan with EXPLAIN QUERY PLAN. A full scan of a large table is rejected unless the outer query 
+# has a LIMIT, doesn't aggregate, needs no temporary B-tree to sort and the scan isn't part of a subquery, and two or more tables scanned in the same loop (a cartesian join) are rejected when 
+# the product of their sizes is too large. Table sizes come from sqlite_stat1 when ANALYZE has been run, and from max(rowid) otherwise, 
+# which SQLite reads from the end of the table's B-tree instead of counting every row. 
+# Queries that pass the check still run under a budget: SQLite's progress handler aborts them after a wall-clock limit or a number of VM steps. 
+# Rejections are returned to the model as a JSON object with an error code, a message and a hint, so it can rewrite the query and try again.
+
+PROGRESS_INTERVAL = 1000  # VM steps between two calls of the progress handler
+
+def mask_sql(query, parentheses=True):
+    """Return the query with string literals, and optionally everything inside parentheses, replaced by spaces."""
+    masked = []
+    depth = 0
+    quote = None
+    for char in query:
+        if quote:
+            masked.append(" ")
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+            masked.append(" ")
+        elif char == "(":
+            masked.append(char if depth == 0 or not parentheses else " ")
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            masked.append(char if depth == 0 or not parentheses else " ")
+        else:
+            masked.append(" " if depth and parentheses else char)
+    return "".join(masked)
+
+
+def select_list(query):
+    """Return the start and end of the outer select list of a query, or None if it has none."""
+    masked = mask_sql(query)
+    select = re.search(r"\bSELECT\s+(?:(?:DISTINCT|ALL)\s+)?", masked, re.IGNORECASE)
+    if not select:
+        return None
+    end = re.compile(r"\bFROM\b", re.IGNORECASE).search(masked, select.end())
+    return select.end(), end.start() if end else len(query)
+
+
+def split_top_level(text, separator=","):
+    """Split text at the separators that are not inside parentheses or string literals."""
+    masked = mask_sql(text)
+    parts, start = [], 0
+    for position, char in enumerate(masked):
+        if char == separator:
+            parts.append(text[start:position].strip())
+            start = position + 1
+    parts.append(text[start:].strip())
+    return parts
+
+
+def output_name(item):
+    """Return the column name SQLite gives to a select item, and the item without its alias."""
+    match = re.fullmatch(r'(.*?[\w)\]"`])\s+(?:AS\s+)?("[^"]+"|\w+)', item, re.IGNORECASE | re.DOTALL)
+    if match and match.group(2).upper() not in ("END", "DESC", "ASC") and not re.search(r"[-+*/%|<>=,(]$", match.group(1).strip()):
+        return match.group(2).strip('"'), match.group(1).strip()
+    column = re.fullmatch(r"\w+\s*\.\s*(\w+)", item)
+    return (column.group(1) if column else item), item
+
+
+TABLE_REFERENCE = re.compile(
+    r'(?:\bFROM|\bJOIN|,)\s*["`\[]?(\w+)["`\]]?'
+    r'(?:\s+(?:AS\s+)?(?!(?:ON|USING|WHERE|JOIN|INNER|LEFT|CROSS|NATURAL|FROM|GROUP|ORDER|LIMIT|HAVING|UNION)\b)(\w+))?',
+    re.IGNORECASE,
+)
+FROM_CLAUSE_END = re.compile(r"(?<![\w.])(?:WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|INTERSECT|EXCEPT|WINDOW)\b", re.IGNORECASE)
+AGGREGATE_FUNCTION = r"\b(?:SUM|TOTAL|COUNT|AVG|MIN|MAX|GROUP_CONCAT)\s*\("
+
+def from_clauses(query):
+    """Return (start, end, depth) of the FROM clause of the query and of each subquery, and the parenthesis depth of every character."""
+    masked = mask_sql(query, parentheses=False)
+    depths = []
+    depth = 0
+    for char in masked:
+        if char == ")":
+            depth -= 1
+        depths.append(depth)
+        if char == "(":
+            depth += 1
+    clauses = []
+    for match in re.finditer(r"\bFROM\b", masked, re.IGNORECASE):
+        depth = depths[match.start()]
+        position = match.end()
+        while position < len(masked) and depths[position] >= depth:
+            if depths[position] == depth and FROM_CLAUSE_END.match(masked, position):
+                break
+            position += 1
+        clauses.append((match.start(), position, depth))
+    return clauses, depths
+
+
+def table_references(query):
+    """Return the TABLE_REFERENCE matches that name a table: a comma only separates tables at the top of a FROM clause."""
+    clauses, depths = from_clauses(query)
+    masked = mask_sql(query, parentheses=False)
+    references = []
+    for match in TABLE_REFERENCE.finditer(query):
+        if masked[match.start()] == " " and not query[match.start()].isspace():
+            continue  # inside a string literal
+        if match.group().startswith(","):
+            position = match.start()
+            if not any(start < position < end and depths[position] == depth for start, end, depth in clauses):
+                continue  # a comma between select items, GROUP BY or ORDER BY terms or function arguments
+        references.append(match)
+    return references
+
+
+def table_aliases(query):
+    """Return a dict mapping the lower-cased table names and aliases used in a query to the table names."""
+    aliases = {}
+    for match in table_references(query):
+        table, alias = match.group(1), match.group(2)
+        aliases[table.lower()] = table
+        if alias:
+            aliases[alias.lower()] = table
+    return aliases
+
+
+class QueryRejected(Exception):
+    """Raised when a query is refused by the plan check or aborted by the execution budget."""
+
+    def __init__(self, error, message, hint, **details):
+        super().__init__(message)
+        self.error = {"error": error, "message": message, "hint": hint, **details}
+
+
+class QueryGuard:
+    """Checks query plans before execution and enforces a wall-clock and VM-step budget during execution."""
+
+    def __init__(self, max_scan_rows=100_000, max_join_rows=1_000_000, time_limit=5.0, step_limit=50_000_000):
+        self.max_scan_rows = max_scan_rows
+        self.max_join_rows = max_join_rows
+        self.time_limit = time_limit
+        self.step_limit = step_limit
+        self._table_rows = None  # lower-cased table name -> row count, filled in lazily
+        self._names = None  # lower-cased table name -> table name
+        self._lock = threading.Lock()
+
+    def table_rows(self, conn, table):
+        """Return the (estimated) number of rows in a table, or None if it isn't a table of the database."""
+        with self._lock:
+            if self._table_rows is None:
+                names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+                self._table_rows = dict.fromkeys((name.lower() for name in names), None)
+                if "sqlite_stat1" in self._table_rows:
+                    for name, stat in conn.execute("SELECT tbl, stat FROM sqlite_stat1;"):
+                        self._table_rows[name.lower()] = int(stat.split()[0])
+                self._names = {name.lower(): name for name in names}
+            if table.lower() not in self._table_rows:
+                return None
+            if self._table_rows[table.lower()] is None:
+                name = self._names[table.lower()].replace('"', '""')
+                try:
+                    rows = conn.execute(f'SELECT max(rowid) FROM "{name}";').fetchone()[0]
+                except sqlite3.OperationalError:
+                    # A WITHOUT ROWID table: count it, but never further than the point where it counts as large
+                    rows = conn.execute(f'SELECT count(*) FROM (SELECT 1 FROM "{name}" LIMIT {self.max_scan_rows + 1});').fetchone()[0]
+                self._table_rows[table.lower()] = rows or 0
+            return self._table_rows[table.lower()]
+
+    def check(self, conn, query, parameters=()):
+        """Return the plan of the query, or raise QueryRejected if it scans or joins too many rows."""
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall()
+        # The plan names tables by their alias, so map the aliases used in the query back to the tables
+        aliases = table_aliases(query)
+        # Only a LIMIT on the outer query bounds the scan, not one inside a subquery or common table expression, 
+        # and not when the outer query aggregates: SUM(v) ... LIMIT 1 still reads every row before it returns one
+        outer = mask_sql(query)
+        top_level = re.search(r"(?<![:@$\w.])LIMIT\b", outer, re.IGNORECASE)
+        aggregate = re.search(AGGREGATE_FUNCTION, outer, re.IGNORECASE) or re.search(r"\bGROUP\s+BY\b", outer, re.IGNORECASE)
+        bounded = top_level and not aggregate and not any("USE TEMP B-TREE" in row[3] for row in plan)
+        nodes = {node: (parent, detail) for node, parent, _, detail in plan}
+
+        def in_subquery(node):
+            # Subqueries, materialized views and CTE co-routines run to completion whatever the outer LIMIT is
+            while node in nodes:
+                node, detail = nodes[node]
+                if re.search(r"SUBQUERY|MATERIALIZE|CO-ROUTINE", detail):
+                    return True
+            return False
+
+        scans = {}
+        for node, parent, _, detail in plan:
+            match = re.match(r"SCAN (\w+)", detail)
+            if not match:
+                continue
+            table = aliases.get(match.group(1).lower(), match.group(1))
+            rows = self.table_rows(conn, table)
+            if rows is None:
+                continue  # a subquery or common table expression, its own tables appear in the plan too
+            scans.setdefault(parent, []).append((table, rows))
+            if rows > self.max_scan_rows and not (bounded and not in_subquery(parent)):
+                raise QueryRejected(
+                    "full_scan",
+                    f"the query scans all {rows} rows of table {table}",
+                    f"filter {table} on an indexed column or add a LIMIT",
+                    table=table,
+                    rows=rows,
+                )
+        for loop in scans.values():
+            if len(loop) < 2:
+                continue
+            rows = 1
+            for _, table_rows in loop:
+                rows *= table_rows
+            if rows > self.max_join_rows:
+                tables = [table for table, _ in loop]
+                raise QueryRejected(
+                    "cartesian_join",
+                    f"the query joins {', '.join(tables)} without a usable join condition, producing up to {rows} row combinations",
+                    "add a join condition on the key columns (e.g. JOIN ... ON a.Id = b.Id)",
+                    tables=tables,
+                    rows=rows,
+                )
+        return plan
+
+    @contextmanager
+    def budget(self, conn):
+        """Abort any statement run on the connection inside the with block once it exceeds the time or step limit."""
+        deadline = time.monotonic() + self.time_limit
+        steps = 0
+        exceeded = []
+
+        def progress():
+            nonlocal steps
+            steps += PROGRESS_INTERVAL
+            if steps > self.step_limit:
+                exceeded.append("step_limit")
+            elif time.monotonic() > deadline:
+                exceeded.append("timeout")
+            return bool(exceeded)
+
+        conn.set_progress_handler(progress, PROGRESS_INTERVAL)
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if exceeded == ["timeout"]:
+                raise QueryRejected("timeout", f"the query ran longer than {self.time_limit} seconds", "simplify the query or narrow it down with a WHERE clause") from e
+            if exceeded == ["step_limit"]:
+                raise QueryRejected("step_limit", f"the query exceeded {self.step_limit} SQLite VM steps", "simplify the query or narrow it down with a WHERE clause") from e
+            raise
+        finally:
+            conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+query_guard = QueryGuard()
+
+def run_guarded(query, parameters, read, record=True, row_limit=None):
+    """Run a guarded query on a pooled connection and return read(conn, query, parameters). Errors are raised to the caller.
+
+    row_limit, if given, is the number of rows read will take from the start of the result; it bounds what sharded queries fetch.
+    """
+    if sharded_database is not None:
+        conn, merge_query = sharded_database.query(query, parameters, row_limit)
+        return read(conn, merge_query, parameters if isinstance(parameters, dict) else ())
+    query = materialized_summaries.rewrite(query)
+    with database_pool.connection() as conn:
+        plan = query_guard.check(conn, query, parameters)
+        start = time.perf_counter()
+        with query_guard.budget(conn):
+            result = read(conn, query, parameters)
+        if record:
+            query_log.record(query, parameters, plan, time.perf_counter() - start)
+        return result
+
+
+def run_query(query, cursor=None, max_rows=PAGE_ROWS, max_bytes=PAGE_BYTES, parameters=()):
+    """Run a guarded query and return one page of results. Errors are raised to the caller."""
+    def read(conn, query, parameters):
+        return fetch_page(conn, query, cursor, max_rows, max_bytes, parameters)
+    # The page ends at most max_rows past the cursor's offset, plus the one row that tells whether another page follows
+    # (fetch_page checks that the cursor belongs to the query)
+    offset = cursor.rpartition(":")[2] if cursor else "0"
+    row_limit = int(offset) + max_rows + 1 if offset.isdigit() else None
+    return run_guarded(query, parameters, read, record=cursor is None, row_limit=row_limit)
+
+
+# Caching query results
+# Questions like "top 5 customers by revenue" produce nearly the same SQL over and over. 
+# Results are cached under the normalized SQL: comments and whitespace are dropped, keywords and identifiers are lower-cased 
+# (SQLite compares them case-insensitively) and numeric literals are written in one canonical form, while string literals are kept exactly. 
+# PRAGMA data_version changes whenever another connection commits to the database, so we watch it on a dedicated connection 
+# and drop the whole cache as soon as it changes. The least recently used entries are evicted once the cache is full, 
+# and the cache reports its hit ratio and the query time saved by the hits. 
+# Only first pages are cached: a continuation cursor always reads from the database.
+
+from collections import OrderedDict
+
+SQL_TOKEN = re.compile(
+    r"""(?P<space>\s+|--[^\n]*|/\*.*?(?:\*/|$))"""
+    r"""|(?P<string>'(?:[^']|'')*')"""
+    r"""|(?P<identifier>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])"""
+    r"""|(?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)"""
+    r"""|(?P<word>\w+)"""
+    r"""|(?P<symbol>.)""",
+    re.DOTALL,
+)
+
+def normalize_sql(query, mask_literals=False):
+    """Return a canonical form of a SQL query, used as the result cache key. With mask_literals every literal becomes a ?."""
+    tokens = []
+    for match in SQL_TOKEN.finditer(query):
+        kind, text = match.lastgroup, match.group()
+        if kind == "space":
+            continue
+        if mask_literals and kind in ("string", "number"):
+            text = "?"
+        elif kind == "number":
+            if text[:2].lower() == "0x":
+                text = str(int(text, 16))
+            elif any(c in text for c in ".eE"):
+                text = repr(float(text))
+            else:
+                text = str(int(text))
+        elif kind in ("word", "identifier"):
+            text = text.lower()
+        tokens.append(text)
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+
+class QueryResultCache:
+    """LRU cache of query results, cleared whenever PRAGMA data_version reports a change to the database."""
+
+    def __init__(self, pool, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.watch = pool.connect()
+        self.data_version = self.watch.execute("PRAGMA data_version;").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.saved_time = 0.0
+
+    def check_data_version(self):
+        # Must be called with the lock held
+        data_version = self.watch.execute("PRAGMA data_version;").fetchone()[0]
+        if data_version != self.data_version:
+            self.data_version = data_version
+            self.entries.clear()
+            self.invalidations += 1
+
+    def call(self, function, query, *args, parameters=()):
+        """Return function(query, None, *args), served from the cache when the same normalized query ran before."""
+        key = (function.__name__, normalize_sql(query), json.dumps(parameters, sort_keys=True), *args)
+        with self.lock:
+            self.check_data_version()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.saved_time += entry[1]
+                self.entries.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+        start = time.perf_counter()
+        result = function(query, None, *args, parameters=parameters)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.entries[key] = (result, elapsed)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "saved_time": self.saved_time,
+        }
+
+query_result_cache = QueryResultCache(database_pool)
+
+def ask_database(query, cursor=None, max_rows=PAGE_ROWS, max_bytes=PAGE_BYTES, result_format="rows"):
     """Function to query SQLite database with a provided SQL query."""
     try:
-        results = str(conn.execute(query).fetchall())
+        # A summary covers the whole result, so it never needs a continuation cursor
+        function = summarize_query if result_format == "summary" else run_query
+        if function is summarize_query or (cursor is None and sharded_database is None):
+            if sharded_database is not None:
+                return function(query, None, max_rows, max_bytes)
+            return query_result_cache.call(function, query, max_rows, max_bytes)
+        return run_query(query, cursor, max_rows, max_bytes)
+    except QueryRejected as e:
+        return json.dumps(e.error)
     except Exception as e:
-        results = f"query failed with error: {e}"
-    return results
+        return json.dumps({"error": "query_failed", "message": str(e), "hint": "fix the SQL and try again"})
+
+
+# Query templates
+# Writing full SQL for every question costs output tokens and latency, and a query written from scratch can't be prepared ahead of time. 
+# Common analytics questions therefore map to named, parameterized query templates, and each template is offered to the model as its own tool: 
+# the model only picks the template and fills in the parameters, and ask_database stays available as the fallback for everything else. 
+# The sqlite3 module keeps a cache of prepared statements per connection, keyed on the SQL text. Since a template's SQL never changes, 
+# it is compiled the first time a pooled connection runs it and reused from then on; only the bound parameters differ.
+
+use_query_templates = True
+
+QUERY_TEMPLATES = {
+    "revenue_by_customer": {
+        "description": "Customers ranked by the total revenue of their invoices, optionally only customers from one country.",
+        "sql": """
+            SELECT c.CustomerId, c.FirstName, c.LastName, c.Country, ROUND(SUM(i.Total), 2) AS Revenue
+            FROM customers AS c JOIN invoices AS i ON i.CustomerId = c.CustomerId
+            WHERE :country IS NULL OR c.Country = :country
+            GROUP BY c.CustomerId
+            ORDER BY Revenue DESC
+            LIMIT :limit
+        """,
+        "parameters": {
+            "country": {"type": "string", "description": "Only include customers from this country, e.g. USA"},
+            "limit": {"type": "integer", "description": "Number of customers to return", "default": 10},
+        },
+    },
+    "tracks_per_album": {
+        "description": "Albums ranked by their number of tracks, optionally only albums whose title contains a search term.",
+        "sql": """
+            SELECT a.AlbumId, a.Title, COUNT(t.TrackId) AS Tracks
+            FROM albums AS a JOIN tracks AS t ON t.AlbumId = a.AlbumId
+            WHERE :title IS NULL OR a.Title LIKE '%' || :title || '%'
+            GROUP BY a.AlbumId
+            ORDER BY Tracks DESC
+            LIMIT :limit
+        """,
+        "parameters": {
+            "title": {"type": "string", "description": "Only include albums whose title contains this text"},
+            "limit": {"type": "integer", "description": "Number of albums to return", "default": 10},
+        },
+    },
+    "employees_by_customers_served": {
+        "description": "Support employees ranked by the number of customers they serve.",
+        "sql": """
+            SELECT e.EmployeeId, e.FirstName, e.LastName, COUNT(c.CustomerId) AS Customers
+            FROM employees AS e JOIN customers AS c ON c.SupportRepId = e.EmployeeId
+            GROUP BY e.EmployeeId
+            ORDER BY Customers DESC
+            LIMIT :limit
+        """,
+        "parameters": {
+            "limit": {"type": "integer", "description": "Number of employees to return", "default": 10},
+        },
+    },
+}
+
+def get_template_tools(templates):
+    """Return one tool definition per query template."""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": name,
+                "description": f"{template['description']} Prefer this over writing SQL with ask_database.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        parameter: {"type": spec["type"], "description": spec["description"]}
+                        for parameter, spec in template["parameters"].items()
+                    },
+                    "required": [],
+                },
+            }
+        }
+        for name, template in templates.items()
+    ]
+
+
+def run_template(name, **arguments):
+    """Run a query template with the parameters chosen by the model. Missing parameters take their default (or NULL)."""
+    template = QUERY_TEMPLATES[name]
+    parameters = {parameter: arguments.get(parameter, spec.get("default")) for parameter, spec in template["parameters"].items()}
+    if "limit" in parameters:
+        # The whole answer fits on one page, so the model never needs a continuation cursor for a template
+        parameters["limit"] = max(1, min(int(parameters["limit"]), PAGE_ROWS))
+    try:
+        if sharded_database is not None:
+            return run_query(template["sql"], None, PAGE_ROWS, PAGE_BYTES, parameters=parameters)
+        return query_result_cache.call(run_query, template["sql"], PAGE_ROWS, PAGE_BYTES, parameters=parameters)
+    except QueryRejected as e:
+        return json.dumps(e.error)
+    except Exception as e:
+        return json.dumps({"error": "query_failed", "message": str(e), "hint": "check the parameters or use ask_database instead"})
+
+if use_query_templates:
+    tools = get_template_tools(QUERY_TEMPLATES) + tools
+
+database_functions = {
+    "ask_database": lambda query, cursor=None, format="rows", **_: ask_database(query, cursor, result_format=format),
+    **{name: functools.partial(run_template, name) for name in QUERY_TEMPLATES},
+}
+
+
+# Schema linking
+# The ask_database tool embeds the database schema in its description, so every request pays for every table and column in prompt tokens. 
+# On a large database that runs into thousands of tokens, while a question usually needs only a handful of tables. 
+# We therefore index the tables once in an in-memory inverted index, and rank them for each question with BM25. 
+# A table's document is made of its name, its column names, the tables it references or is referenced by through foreign keys, 
+# and a few sample values, so "customers" finds the customers table and the invoices that point to it, and "AC/DC" finds the artists table. 
+# Names are split into words (FirstName gives first, name and firstname), a trailing plural s is dropped and common English words are ignored. 
+# Only the top-k tables go into the tool description; when nothing in the question matches we fall back to the full schema.
+
+import math
+from collections import Counter, defaultdict
+
+SCHEMA_LINKING_TOP_K = 5
+STOP_WORDS = set("""
+    a about all an and any are as at be by can do does for from give given have how i in is it its many me most much
+    of on or our show than that the their there these they this to top us was we what when where which who whose with you your
+""".split())
+
+def schema_terms(text):
+    """Split names and free text into lower-case terms for the schema index."""
+    terms = []
+    for word in re.findall(r"[A-Za-z0-9]+", text):
+        parts = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", word)
+        for part in parts + ([word] if len(parts) > 1 else []):
+            term = part.lower()
+            if term in STOP_WORDS:
+                continue
+            if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+                term = term[:-1]
+            terms.append(term)
+    return terms
+
+
+class SchemaIndex:
+    """BM25 ranking of database tables against a question, over an inverted index built once."""
+
+    def __init__(self, tables, k1=1.2, b=0.75):
+        self.tables = tables
+        self.k1 = k1
+        self.b = b
+        referenced_by = defaultdict(list)
+        for table in tables:
+            for _, parent_table, _ in table.get("foreign_keys", []):
+                referenced_by[parent_table].append(table["table_name"])
+        self.postings = defaultdict(dict)  # term -> {table position: term frequency}
+        self.lengths = []
+        for position, table in enumerate(tables):
+            if table["table_name"].startswith("sqlite_"):
+                # SQLite's internal tables never answer a question, keep them out of the ranking
+                self.lengths.append(0)
+                continue
+            text = [table["table_name"], table["table_name"], *table["column_names"]]  # the table name counts twice
+            text += [parent_table for _, parent_table, _ in table.get("foreign_keys", [])]
+            text += referenced_by[table["table_name"]]
+            text += table.get("sample_values", [])
+            terms = Counter(schema_terms(" ".join(text)))
+            for term, frequency in terms.items():
+                self.postings[term][position] = frequency
+            self.lengths.append(sum(terms.values()))
+        self.average_length = sum(self.lengths) / max(1, sum(1 for length in self.lengths if length))
+
+    def search(self, question, top_k=SCHEMA_LINKING_TOP_K):
+        """Return the top_k tables that best match the question, best first. Tables that match no term are left out."""
+        scores = defaultdict(float)
+        for term in set(schema_terms(question)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.tables) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings.items():
+                length_norm = 1 - self.b + self.b * self.lengths[position] / self.average_length
+                scores[position] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+        return [self.tables[position] for position in ranked]
+
+schema_index = SchemaIndex(database_schema_dict)
+
+def get_question_tools(question, top_k=SCHEMA_LINKING_TOP_K):
+    """Return the tool definitions for a question, with only the linked tables in the ask_database description."""
+    linked_tables = schema_index.search(question, top_k) or database_schema_dict
+    question_tools = get_tools(get_schema_string(linked_tables))
+    if use_query_templates:
+        question_tools = get_template_tools(QUERY_TEMPLATES) + question_tools
+    return question_tools, linked_tables
+
+
+# Index advisor
+# The SQL the model writes keeps repeating the same access patterns, and some of them hit tables without a supporting index. 
+# Every query that runs is recorded in a query log together with its plan and run time. The log is keyed on the normalized SQL with 
+# its literals masked, so the same question asked for another customer or country counts as the same access pattern. 
+# The advisor looks for queries that ran repeatedly and whose plan scans a whole table (SCAN without an index) or sorts in a temporary B-tree, 
+# and proposes a covering index for the table: first the columns it is filtered on, then the columns it is grouped or sorted by, 
+# then the other columns the query reads, so the query can be answered from the index alone. 
+# Our connections are read-only, so the indexes are tried on a writable copy of the database, which reports the timing before and after.
+
+INDEX_ADVISOR_COPY_PATH = DATABASE_PATH.rsplit(".", 1)[0] + ".advisor.db"
+MAX_INDEX_COLUMNS = 6
+
+run_index_advisor = True
+
+class QueryLog:
+    """LRU-bounded log of executed query patterns with their plan, run count and total run time."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record(self, query, parameters, plan, elapsed):
+        key = normalize_sql(query, mask_literals=True)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"runs": 0, "total_time": 0.0}
+            # Keep the latest instance of the pattern, it is the one the advisor times
+            entry.update(query=query, parameters=parameters, plan=[row[3] for row in plan])
+            entry["runs"] += 1
+            entry["total_time"] += elapsed
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def queries(self):
+        with self.lock:
+            return list(self.entries.values())
+
+query_log = QueryLog()
+
+SQL_CLAUSE = re.compile(r"\b(SELECT|FROM|JOIN|ON|WHERE|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT)\b", re.IGNORECASE)
+
+def column_roles(query, table, aliases, columns, tables):
+    """Split the columns of table used by a query into filtered, grouped/sorted and other columns."""
+    names = {name for name, target in aliases.items() if target.lower() == table.lower()}
+    other_columns = {column.lower() for name in tables if name.lower() != table.lower() for column in columns.get(name.lower(), [])}
+    table_columns = {column.lower(): column for column in columns.get(table.lower(), [])}
+    roles = {"filter": [], "order": [], "other": []}
+    parts = SQL_CLAUSE.split(query)
+    clause = "SELECT"
+    for part in parts:
+        if SQL_CLAUSE.fullmatch(part):
+            clause = " ".join(part.upper().split())
+            continue
+        # Join columns count as other columns: the advisor only looks at scanned tables, which drive the join rather than being looked up
+        role = {"ON": "other", "WHERE": "filter", "GROUP BY": "order", "ORDER BY": "order", "SELECT": "other", "HAVING": "other"}.get(clause)
+        if role is None:
+            continue
+        for qualifier, column in re.findall(r'(?:(\w+)\s*\.\s*)?\b(\w+)\b(?!\s*\()', part):
+            column = column.lower()
+            if column not in table_columns:
+                continue
+            if qualifier and qualifier.lower() not in names:
+                continue
+            if not qualifier and len(tables) > 1 and column in other_columns:
+                continue  # an unqualified column that more than one table has, we can't tell which one is meant
+            roles[role].append(table_columns[column])
+    return roles
+
+
+class IndexAdvisor:
+    """Proposes covering indexes for repeated full scans and temporary sorts in the query log, and measures them on a copy."""
+
+    def __init__(self, query_log, schema, min_runs=2):
+        self.query_log = query_log
+        self.columns = {table["table_name"].lower(): table["column_names"] for table in schema}
+        self.min_runs = min_runs
+
+    def proposals(self):
+        """Return a list of proposed indexes, each with its CREATE INDEX statement and the queries it is meant for."""
+        proposals = {}
+        for entry in self.query_log.queries():
+            if entry["runs"] < self.min_runs:
+                continue
+            query, plan = entry["query"], entry["plan"]
+            aliases = table_aliases(query)
+            tables = sorted({table for table in aliases.values() if table.lower() in self.columns})
+            temp_sort = any("USE TEMP B-TREE" in detail for detail in plan)
+            for detail in plan:
+                match = re.match(r"SCAN (\w+)", detail)
+                if not match or "COVERING INDEX" in detail:
+                    continue
+                table = aliases.get(match.group(1).lower(), match.group(1))
+                if table.lower() not in self.columns:
+                    continue  # a subquery or common table expression
+                roles = column_roles(query, table, aliases, self.columns, tables)
+                if not roles["filter"] and not (temp_sort and roles["order"]):
+                    continue  # nothing an index could look up or sort by, the scan is the cheapest plan
+                index_columns = list(dict.fromkeys(roles["filter"] + roles["order"] + roles["other"]))[:MAX_INDEX_COLUMNS]
+                name = f"advisor_{table}_{'_'.join(index_columns)}".lower()
+                column_list = ", ".join(f'"{column}"' for column in index_columns)
+                proposal = proposals.setdefault(name, {
+                    "name": name,
+                    "table": table,
+                    "columns": index_columns,
+                    "sql": f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list});',
+                    "queries": [],
+                })
+                proposal["queries"].append(entry)
+        return list(proposals.values())
+
+    @staticmethod
+    def time_query(conn, query, parameters, repeat=5):
+        """Return the best of repeat full runs of a query, in seconds."""
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(query, parameters).fetchall()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def evaluate(self, pool, copy_path=INDEX_ADVISOR_COPY_PATH):
+        """Create the proposed indexes on a writable copy of the database and report the query timings before and after."""
+        proposals = self.proposals()
+        if not proposals:
+            return []
+        with pool.connection() as source, closing(sqlite3.connect(copy_path)) as copy:
+            source.backup(copy)
+            entries = {id(entry): entry for proposal in proposals for entry in proposal["queries"]}
+            before = {key: self.time_query(copy, entry["query"], entry["parameters"]) for key, entry in entries.items()}
+            for proposal in proposals:
+                copy.execute(proposal["sql"])
+            copy.execute("ANALYZE;")
+            copy.commit()
+            report = []
+            for key, entry in entries.items():
+                report.append({
+                    "query": entry["query"],
+                    "runs": entry["runs"],
+                    "before": before[key],
+                    "after": self.time_query(copy, entry["query"], entry["parameters"]),
+                    "plan_before": entry["plan"],
+                    "plan_after": [row[3] for row in copy.execute(f"EXPLAIN QUERY PLAN {entry['query']}", entry["parameters"])],
+                })
+        return report
+
+index_advisor = IndexAdvisor(query_log, database_schema_dict)
+
+
+# Materialized summaries
+# Questions like "top customers by revenue" or "album with the most tracks" rerun the same GROUP BY join every time they are asked. 
+# We keep their aggregates in summary tables (revenue per customer, tracks per album, customers per support rep) inside the database. 
+# Triggers on the base tables record the key of every changed row in a change log, and a refresh recomputes only the groups whose keys 
+# are in the log instead of the whole summary. The refresh runs on a writable connection whenever PRAGMA data_version shows that 
+# someone else committed to the database. 
+# Queries are rewritten transparently: when a query reads a base table only through its group key and aggregates the summary can answer 
+# (e.g. SUM(i.Total) for invoices), the base table is replaced by its summary. SUM and COUNT are decomposable, so summing the per-key 
+# aggregates gives the same result (up to floating point rounding) for any grouping on the key or coarser, with one summary row per key instead of one per base row. 
+# The summary tables start with mv_ and are left out of the schema shown to the model. When the database can't be written, nothing is rewritten. 
+# A rewritten select item keeps the column name of the original (SUM(Total) stays SUM(Total)), so the rewrite never shows in the results. 
+# This changes the user's database for good: it adds the mv_changes log and its index, one mv_ table per summary and an insert, update 
+# and delete trigger on each base table. The triggers keep logging every outside write, also while this script isn't running, and the log 
+# is only emptied by the next refresh. That is why summaries are opt-in; drop the mv_ tables and triggers to undo it. 
+# verify() runs queries both ways and reports any difference, or any query it expected to rewrite but didn't, as a check after 
+# changing MATERIALIZED_SUMMARIES.
+
+use_materialized_summaries = False
+
+MATERIALIZED_SUMMARIES = {
+    "mv_customer_revenue": {
+        "table": "invoices",
+        "key": "CustomerId",
+        "columns": {"Revenue": "SUM(Total)", "Invoices": "COUNT(*)"},
+        # (aggregate function, base column) -> the same aggregate over the summary
+        "aggregates": {
+            ("SUM", "total"): "SUM({alias}.Revenue)",
+            ("TOTAL", "total"): "TOTAL({alias}.Revenue)",
+            ("COUNT", "invoiceid"): "COALESCE(SUM({alias}.Invoices), 0)",
+        },
+    },
+    "mv_album_tracks": {
+        "table": "tracks",
+        "key": "AlbumId",
+        "columns": {"Tracks": "COUNT(*)"},
+        "aggregates": {
+            ("COUNT", "trackid"): "COALESCE(SUM({alias}.Tracks), 0)",
+        },
+    },
+    "mv_rep_customers": {
+        "table": "customers",
+        "key": "SupportRepId",
+        "columns": {"Customers": "COUNT(*)"},
+        "aggregates": {
+            ("COUNT", "customerid"): "COALESCE(SUM({alias}.Customers), 0)",
+        },
+    },
+}
+
+# Queries verify() checks against the summaries: a single-table aggregate and each summary joined to its parent table. They have no 
+# LIMIT, which could cut ties between equal aggregates differently
+SUMMARY_CHECK_QUERIES = [
+    "SELECT SUM(Total) FROM invoices WHERE CustomerId = 5",
+    "SELECT CustomerId, SUM(Total), COUNT(InvoiceId) AS n FROM invoices GROUP BY CustomerId",
+    "SELECT c.Country, TOTAL(i.Total) FROM customers AS c LEFT JOIN invoices AS i ON i.CustomerId = c.CustomerId GROUP BY c.Country",
+    "SELECT a.Title, COUNT(t.TrackId) FROM albums a JOIN tracks t ON t.AlbumId = a.AlbumId GROUP BY a.AlbumId",
+    "SELECT e.LastName, COUNT(c.CustomerId) AS Customers FROM employees e JOIN customers c ON c.SupportRepId = e.EmployeeId GROUP BY e.EmployeeId",
+]
+
+AGGREGATE_CALL = r"\b(SUM|TOTAL|COUNT|AVG|MIN|MAX)\s*\(\s*(DISTINCT\s+)?{qualifier}(\w+)\s*\)"
+
+class MaterializedSummaries:
+    """Summary tables maintained incrementally from a trigger-fed change log, with transparent query rewriting."""
+
+    def __init__(self, pool, summaries, schema):
+        self.summaries = summaries
+        self.columns = {table["table_name"].lower(): [column.lower() for column in table["column_names"]] for table in schema}
+        self.lock = threading.Lock()
+        self.refreshes = 0
+        self.rewrites = 0
+        self.conn = None
+        if not summaries:
+            return  # nothing to maintain, so the database is left untouched
+        try:
+            self.conn = sqlite3.connect(f"{pool.uri}?mode=rw", uri=True, check_same_thread=False)
+            self.install()
+        except sqlite3.Error as e:
+            print(f"Materialized summaries disabled: {e}")
+            self.conn = None
+            return
+        self.data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def install(self):
+        """Create the change log, the summary tables and their triggers, unless they exist already."""
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS mv_changes (summary TEXT NOT NULL, key);")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS mv_changes_summary_key ON mv_changes (summary, key);")
+            for name, summary in self.summaries.items():
+                table, key = summary["table"], summary["key"]
+                exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,)).fetchone()
+                if not exists:
+                    columns = ", ".join(summary["columns"])
+                    self.conn.execute(f"CREATE TABLE {name} ({key} PRIMARY KEY, {columns});")
+                    self.conn.execute(f"INSERT INTO {name} SELECT {key}, {self.measures(summary)} FROM {table} GROUP BY {key};")
+                for event, keys in (("INSERT", ["NEW"]), ("UPDATE", ["OLD", "NEW"]), ("DELETE", ["OLD"])):
+                    log = " ".join(f"INSERT INTO mv_changes VALUES ('{name}', {row}.{key});" for row in keys)
+                    self.conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name}_{event.lower()} AFTER {event} ON {table} BEGIN {log} END;")
+
+    @staticmethod
+    def measures(summary):
+        return ", ".join(summary["columns"].values())
+
+    def refresh(self):
+        """Recompute the summary rows of every key in the change log, then clear the log."""
+        with self.conn:
+            last_change = self.conn.execute("SELECT max(rowid) FROM mv_changes;").fetchone()[0]
+            if last_change is None:
+                return
+            for name, summary in self.summaries.items():
+                table, key = summary["table"], summary["key"]
+                changed = f"EXISTS (SELECT 1 FROM mv_changes AS c WHERE c.summary = '{name}' AND c.rowid <= {last_change} AND c.key IS {{}}.{key})"
+                self.conn.execute(f"DELETE FROM {name} WHERE {changed.format(name)};")
+                self.conn.execute(f"INSERT INTO {name} SELECT {key}, {self.measures(summary)} FROM {table} WHERE {changed.format(table)} GROUP BY {key};")
+            self.conn.execute("DELETE FROM mv_changes WHERE rowid <= ?;", (last_change,))
+        self.refreshes += 1
+
+    def refresh_if_changed(self):
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+            if data_version != self.data_version:
+                self.refresh()
+                self.data_version = data_version
+
+    def rewrite(self, query):
+        """Return the query with base tables replaced by their summaries where that gives the same result."""
+        if self.conn is None:
+            return query
+        self.refresh_if_changed()
+        for name, summary in self.summaries.items():
+            rewritten = self.rewrite_table(query, name, summary)
+            if rewritten != query:
+                self.rewrites += 1
+                query = rewritten
+        return query
+
+    def rewrite_table(self, query, name, summary):
+        table, key = summary["table"].lower(), summary["key"].lower()
+        references = [match for match in table_references(query) if match.group(1).lower() == table]
+        if len(references) != 1:
+            return query  # the table isn't used, or used more than once (e.g. a self join)
+        reference = references[0]
+        alias = reference.group(2) or reference.group(1)
+        tables = set(table_aliases(query).values())
+        qualifier = rf"\b{alias}\s*\.\s*"
+        if len(tables) == 1:
+            qualifier = f"(?:{qualifier})?"  # a single-table query may leave its columns unqualified
+        unsupported = []
+        replaced = []
+
+        def replace_aggregate(match):
+            function, distinct, column = match.group(1).upper(), match.group(2), match.group(3).lower()
+            replacement = summary["aggregates"].get((function, column))
+            if column not in self.columns.get(table, []):
+                return match.group()  # not a column of the base table, e.g. COUNT(x.Name) of another alias
+            if replacement is None or distinct:
+                unsupported.append(match.group())
+                return match.group()
+            replaced.append(match.group())
+            return replacement.format(alias=alias)
+
+        start, end = reference.start(1), reference.end()
+        if query[start - 1] in "\"`[":
+            start -= 1  # a quoted table name
+        rewritten = query[:start] + f"{name} AS {alias}" + query[end:]
+        rewritten = re.sub(AGGREGATE_CALL.format(qualifier=qualifier), replace_aggregate, rewritten, flags=re.IGNORECASE)
+        # Every aggregate must be one we rewrote: the summary has one row per key, so aggregates over the other tables, 
+        # or COUNT(*), would see fewer joined rows than before
+        if unsupported or not replaced or len(re.findall(AGGREGATE_FUNCTION, query, re.IGNORECASE)) != len(replaced):
+            return query
+        # Apart from the rewritten aggregates the query may only use the base table's group key
+        summary_columns = {column.lower() for column in summary["columns"]}
+        for column in re.findall(rf"\b{alias}\s*\.\s*(\w+)", rewritten, re.IGNORECASE):
+            if column.lower() not in (key, *summary_columns):
+                return query
+        other_tables = {other.lower() for other in tables} - {table}
+        other_columns = {column for other in other_tables for column in self.columns.get(other, [])}
+        # Words followed by a dot are qualifiers and words followed by a parenthesis are function names, e.g. TOTAL(i.Total)
+        for word in re.findall(r"(?<![\w.])(\w+)\b(?!\s*[.(])", rewritten):
+            word = word.lower()
+            if word in self.columns.get(table, []) and word != key and (not other_tables or word not in other_columns):
+                return query  # an unqualified column of the base table
+        return self.keep_output_names(query, rewritten)
+
+    @staticmethod
+    def keep_output_names(query, rewritten):
+        """Alias every rewritten select item that had no alias to its original text, which SQLite uses as its column name."""
+        spans = [select_list(text) for text in (query, rewritten)]
+        if None in spans:
+            return rewritten
+        (start, end), (rewritten_start, rewritten_end) = spans
+        items = split_top_level(query[start:end])
+        rewritten_items = split_top_level(rewritten[rewritten_start:rewritten_end])
+        if len(items) != len(rewritten_items):
+            return rewritten
+        for position, (item, rewritten_item) in enumerate(zip(items, rewritten_items)):
+            if item != rewritten_item and output_name(item)[1] == item:
+                name = item.replace('"', '""')
+                rewritten_items[position] = f'{rewritten_item} AS "{name}"'
+        return rewritten[:rewritten_start] + ", ".join(rewritten_items) + " " + rewritten[rewritten_end:]
+
+    def verify(self, pool, queries):
+        """Run every query as written and rewritten, and return the ones that weren't rewritten or whose column names or rows differ."""
+        if self.conn is None:
+            return []
+        self.refresh_if_changed()
+        mismatches = []
+        with pool.connection() as conn:
+            for query in queries:
+                rewritten = query
+                for name, summary in self.summaries.items():
+                    rewritten = self.rewrite_table(rewritten, name, summary)
+                if rewritten == query:
+                    mismatches.append({"query": query, "problem": "not rewritten"})
+                    continue
+                results = []
+                for text in (query, rewritten):
+                    db_cursor = conn.execute(text)
+                    rows = [tuple(round(value, 6) if isinstance(value, float) else value for value in row) for row in db_cursor]
+                    results.append(([column[0] for column in db_cursor.description], sorted(rows, key=repr)))
+                if results[0] != results[1]:
+                    mismatches.append({"query": query, "rewritten": rewritten, "problem": "different results"})
+        return mismatches
+
+    def stats(self):
+        return {"refreshes": self.refreshes, "rewrites": self.rewrites}
+
+materialized_summaries = MaterializedSummaries(database_pool, MATERIALIZED_SUMMARIES if use_materialized_summaries else {}, database_schema_dict)
+
+
+# Sharded databases
+# When the data is split into many SQLite files (e.g. one per region), set DATABASE_SHARDS to a glob pattern matching them. 
+# ask_database then runs every query on all shards at once in a process pool, so one tool call uses all cores, and merges the results. 
+# The shards must share the schema of DATABASE_PATH, which is still used for the schema shown to the model. 
+# Merging happens in an in-memory SQLite database: 
+# - A plain query runs unchanged on every shard, with its LIMIT raised by the OFFSET, and the merge applies ORDER BY, LIMIT and OFFSET again. 
+#   Without a LIMIT, each shard returns only the rows needed up to the end of the page being read, so paging doesn't copy whole tables. 
+# - An aggregate query is split in two: each shard computes partial aggregates per group (SUM, COUNT, MIN, MAX, and SUM plus COUNT for AVG), 
+#   and the merge combines them (SUM of the sums and counts, MIN of the minimums, ...) before applying HAVING, ORDER BY and LIMIT. 
+# ORDER BY must refer to selected columns, group expressions or aggregates. Compound queries and COUNT(DISTINCT ...) can't be merged 
+# this way and are rejected with an error. The result cache and the plan guard are bypassed, but every shard query has the same time limit. 
+# Worker processes are forked, because the spawn start method would re-run this whole script in every worker. They are all forked 
+# up front at import, while the script still runs a single thread: forking later from a call_database_tools thread, while other threads 
+# hold locks (e.g. inside sqlite3 or the logging module), could leave a child deadlocked on a lock nobody will release. 
+# where fork isn't available the shards are queried from threads instead, which still overlap since SQLite releases the GIL.
+
+import glob
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+SHARD_PATHS = sorted(glob.glob(os.environ["DATABASE_SHARDS"])) if os.environ.get("DATABASE_SHARDS") else []
+
+shard_connections = {}  # (shard path, thread) -> connection, in each worker process
+
+def query_shard(path, query, parameters=(), time_limit=None):
+    """Run a read query on one shard and return its column names and rows. Runs in a worker process."""
+    key = (path, threading.get_ident())
+    conn = shard_connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        shard_connections[key] = restrict_to_reads(conn)
+    if time_limit is not None:
+        deadline = time.monotonic() + time_limit
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_INTERVAL)
+    try:
+        db_cursor = conn.execute(query, parameters)
+        return [column[0] for column in db_cursor.description or []], db_cursor.fetchall()
+    finally:
+        conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+
+SQL_CLAUSES = re.compile(r"(?<![:@$\w.])(SELECT|FROM|WHERE|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|INTERSECT|EXCEPT|WINDOW)\b", re.IGNORECASE)
+AGGREGATE_START = re.compile(r"\b(SUM|TOTAL|COUNT|AVG|MIN|MAX)\s*\(", re.IGNORECASE)
+
+def split_clauses(query):
+    """Split the top level of a SELECT statement into its WITH prefix and a dict of clauses."""
+    query = query.strip().rstrip(";")
+    matches = list(SQL_CLAUSES.finditer(mask_sql(query)))
+    if not matches or matches[0].group(1).upper() != "SELECT":
+        raise ValueError("only SELECT queries can run on shards")
+    clauses = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        name = " ".join(match.group(1).upper().split())
+        if name in clauses or name in ("UNION", "INTERSECT", "EXCEPT", "WINDOW"):
+            raise ValueError(f"{name} queries can't be merged across shards")
+        clauses[name] = query[match.end():following.start() if following else len(query)].strip()
+    return query[:matches[0].start()], clauses
+
+
+def find_aggregates(expression):
+    """Return (start, end, function, argument) for every top-level aggregate call in an expression."""
+    masked = mask_sql(expression, parentheses=False)
+    calls, end = [], 0
+    for match in AGGREGATE_START.finditer(masked):
+        if match.start() < end:
+            continue  # nested inside the previous aggregate
+        depth, position = 1, match.end()
+        while depth and position < len(masked):
+            depth += {"(": 1, ")": -1}.get(masked[position], 0)
+            position += 1
+        argument = expression[match.end():position - 1].strip()
+        if len(split_top_level(argument)) > 1:
+            continue  # min(a, b) and max(a, b) are scalar functions
+        end = position
+        calls.append((match.start(), end, match.group(1).upper(), argument))
+    return calls
+
+
+class ShardedDatabase:
+    """Runs a read query on every shard database in a process pool and merges the results."""
+
+    def __init__(self, paths, max_workers=None, time_limit=None):
+        self.paths = paths
+        self.time_limit = time_limit
+        max_workers = max_workers or min(len(paths), os.cpu_count() or 1)
+        if "fork" in multiprocessing.get_all_start_methods():
+            self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"))
+            # The executor forks its workers on the first submit, so submit now instead of from a worker thread later
+            for future in [self.executor.submit(os.getpid) for _ in range(max_workers)]:
+                future.result()
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @staticmethod
+    def merge_expression(expression, partials, group_by):
+        """Return the merge-side form of an expression, adding the partial aggregates it needs to partials."""
+        for position, group in enumerate(group_by):
+            if normalize_sql(expression) == normalize_sql(group):
+                return f"g{position}"
+
+        def partial(shard_expression):
+            partials.append(shard_expression)
+            return f"c{len(partials) - 1}"
+
+        calls = find_aggregates(expression)
+        if not calls:
+            # A bare column of the group (SQLite allows those), it has the same value on every shard
+            return f"MIN({partial(expression)})"
+        for start, end, function, argument in reversed(calls):
+            if re.match(r"DISTINCT\b", argument, re.IGNORECASE):
+                raise ValueError(f"{function}(DISTINCT ...) can't be merged across shards")
+            if function == "AVG":
+                merged = f"CAST(SUM({partial(f'SUM({argument})')}) AS REAL) / SUM({partial(f'COUNT({argument})')})"
+            elif function == "COUNT":
+                merged = f"SUM({partial(f'COUNT({argument})')})"
+            else:
+                merged = f"{function}({partial(f'{function}({argument})')})"
+            expression = expression[:start] + merged + expression[end:]
+        return expression
+
+    @staticmethod
+    def parse_limit(limit):
+        """Return the (limit, offset) expressions of a LIMIT clause."""
+        if limit is None:
+            return None, None
+        parts = re.split(r"\s+OFFSET\s+", mask_sql(limit), flags=re.IGNORECASE)
+        if len(parts) == 2:
+            return limit[:len(parts[0])].strip(), limit[len(limit) - len(parts[1]):].strip()
+        parts = split_top_level(limit)
+        if len(parts) == 2:
+            return parts[1], parts[0]  # LIMIT offset, count
+        return limit, None
+
+    def order_term(self, term, names, items, partials, group_by, aggregate):
+        """Return the merge-side form of one ORDER BY term."""
+        match = re.fullmatch(r"(.*?)((?:\s+COLLATE\s+\w+)?(?:\s+(?:ASC|DESC))?(?:\s+NULLS\s+(?:FIRST|LAST))?)", term, re.IGNORECASE | re.DOTALL)
+        expression, direction = match.group(1).strip(), match.group(2)
+        if expression.isdigit():
+            return expression + direction
+        for position, name in enumerate(names):
+            if expression.strip('"').lower() == name.lower():
+                return f"{position + 1}{direction}"
+        for position, (_, item) in enumerate(items):
+            if normalize_sql(expression) == normalize_sql(item):
+                return f"{position + 1}{direction}"
+        if aggregate:
+            return self.merge_expression(expression, partials, group_by) + direction
+        column = re.fullmatch(r"\w+\s*\.\s*(\w+)", expression)
+        for position, name in enumerate(names):
+            if column and column.group(1).lower() == name.lower():
+                return f"{position + 1}{direction}"
+        raise ValueError(f"ORDER BY {expression} must refer to a selected column when querying shards")
+
+    def query(self, query, parameters=(), row_limit=None):
+        """Run the query on every shard. Returns an in-memory connection holding the partial results, and the query that merges them.
+
+        row_limit is the number of rows the caller reads from the start of the merged result, e.g. up to the end of the page it shows.
+        Shards then return no more rows of a plain query than that, instead of their whole result.
+        """
+        head, clauses = split_clauses(query)
+        select = clauses["SELECT"]
+        distinct = re.match(r"(DISTINCT|ALL)\s+", select, re.IGNORECASE)
+        items = [output_name(item) for item in split_top_level(select[distinct.end() if distinct else 0:])]  # (name, expression)
+        group_by = split_top_level(clauses["GROUP BY"]) if "GROUP BY" in clauses else []
+        # The shard query drops the select list, so GROUP BY ordinals and aliases are replaced by the expressions they stand for
+        aliases = {name.lower(): expression for name, expression in items if normalize_sql(name) != normalize_sql(expression)}
+        group_by = [
+            items[int(group) - 1][1] if group.isdigit() and 0 < int(group) <= len(items) else aliases.get(group.strip('"').lower(), group)
+            for group in group_by
+        ]
+        limit, offset = self.parse_limit(clauses.get("LIMIT"))
+        source = "".join(f" {name} {clauses[name]}" for name in ("FROM", "WHERE") if name in clauses)
+        aggregate = bool(group_by) or any(find_aggregates(expression) for _, expression in items)
+        if aggregate:
+            partials = []
+            merge_items = [f'{self.merge_expression(expression, partials, group_by)} AS "{name}"' for name, expression in items]
+            names = [name for name, _ in items]
+            merge_query = f"SELECT {', '.join(merge_items)} FROM partials"
+            if group_by:
+                merge_query += f" GROUP BY {', '.join(f'g{position}' for position in range(len(group_by)))}"
+            if "HAVING" in clauses:
+                merge_query += f" HAVING {self.merge_expression(clauses['HAVING'], partials, group_by)}"
+            if "ORDER BY" in clauses:
+                terms = [self.order_term(term, names, items, partials, group_by, True) for term in split_top_level(clauses["ORDER BY"])]
+                merge_query += f" ORDER BY {', '.join(terms)}"
+            # HAVING and ORDER BY may need partial aggregates of their own, so the shard query is built last
+            columns = [f"{group} AS g{position}" for position, group in enumerate(group_by)]
+            columns += [f"{expression} AS c{position}" for position, expression in enumerate(partials)]
+            shard_query = f"{head}SELECT {', '.join(columns)}{source}"
+            if group_by:
+                shard_query += f" GROUP BY {', '.join(group_by)}"
+        else:
+            shard_query = f"{head}SELECT {select}{source}"
+            if "ORDER BY" in clauses:
+                shard_query += f" ORDER BY {clauses['ORDER BY']}"
+            if limit is not None and row_limit is not None:
+                shard_query += f" LIMIT min(({limit}), {row_limit}) + ({offset or 0})"
+            elif limit is not None:
+                # Every shard returns enough rows to fill the page after the merge has skipped the offset
+                shard_query += f" LIMIT ({limit}) + ({offset or 0})"
+            elif row_limit is not None:
+                shard_query += f" LIMIT {row_limit}"
+        results = list(self.executor.map(query_shard, self.paths, repeat(shard_query), repeat(parameters), repeat(self.time_limit)))
+        width = len(results[0][0]) if results else 0
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        if aggregate:
+            conn.execute(f"CREATE TABLE partials ({', '.join(results[0][0])});")
+        else:
+            # Column names of a plain query may repeat, so the partials table numbers its columns
+            names = results[0][0] if results else []
+            conn.execute(f"CREATE TABLE partials ({', '.join(f'c{position}' for position in range(width)) or 'c0'});")
+            merge_items = [f'c{position} AS "{name}"' for position, name in enumerate(names)]
+            keyword = "DISTINCT " if distinct and distinct.group(1).upper() == "DISTINCT" else ""
+            merge_query = f"SELECT {keyword}{', '.join(merge_items) or '*'} FROM partials"
+            if "ORDER BY" in clauses:
+                terms = [self.order_term(term, names, items, [], [], False) for term in split_top_level(clauses["ORDER BY"])]
+                merge_query += f" ORDER BY {', '.join(terms)}"
+        if width:
+            rows = (row for _, shard_rows in results for row in shard_rows)
+            conn.executemany(f"INSERT INTO partials VALUES ({', '.join('?' for _ in range(width))});", rows)
+        if limit is not None:
+            merge_query += f" LIMIT {limit}" + (f" OFFSET {offset}" if offset is not None else "")
+        return conn, merge_query
+
+sharded_database = ShardedDatabase(SHARD_PATHS, time_limit=query_guard.time_limit) if SHARD_PATHS else None
+
+
+# Columnar results
+# Tools that post-process query results want a DataFrame, not the text page written for the model. 
+# The sqlite3 module hands out every row as a tuple of Python objects, so instead of keeping the whole result as a list of tuples 
+# we read it in batches and convert each batch into one Arrow array per column straight away. Only one batch of tuples is alive at a time, 
+# and the DataFrame is built on the Arrow buffers (pandas ArrowDtype columns) without converting them back into Python objects. 
+# A column whose values have mixed types in SQLite is widened to float when they are all numbers, and stored as text otherwise. 
+# For the model, summarize_dataframe turns a result into a compact summary (row count, per-column statistics and the first rows), 
+# which ask_database returns with format="summary" instead of the rows themselves.
+
+import pandas as pd
+import pyarrow as pa
+
+DATAFRAME_BATCH_ROWS = 10_000
+SUMMARY_HEAD_ROWS = 5
+
+def arrow_column(values):
+    """Convert one batch of a column's values into an Arrow array."""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+
+
+def combine_chunks(chunks):
+    """Combine the batches of one column into a chunked array, casting them to a common type when the batches differ."""
+    types = {chunk.type for chunk in chunks if chunk.type != pa.null()}
+    if len(types) > 1:
+        common = pa.float64() if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types) else pa.string()
+    else:
+        common = types.pop() if types else pa.null()
+    return pa.chunked_array([chunk if chunk.type == common else chunk.cast(common) for chunk in chunks], type=common)
+
+
+def read_dataframe(conn, query, parameters=(), batch_rows=DATAFRAME_BATCH_ROWS):
+    """Read the whole result of a query into a pandas DataFrame backed by Arrow columns."""
+    db_cursor = conn.execute(query, parameters)
+    if db_cursor.description is None:
+        return pd.DataFrame()
+    names = [column[0] for column in db_cursor.description]
+    chunks = [[] for _ in names]
+    while True:
+        rows = db_cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        for position, values in enumerate(zip(*rows)):
+            chunks[position].append(arrow_column(values))
+    columns = [combine_chunks(column_chunks) if column_chunks else pa.chunked_array([], type=pa.null()) for column_chunks in chunks]
+    table = pa.table(columns, names=[f"c{position}" for position in range(len(names))])
+    dataframe = table.to_pandas(types_mapper=pd.ArrowDtype)
+    dataframe.columns = names  # set afterwards, Arrow tables need unique column names
+    return dataframe
+
+
+def query_dataframe(query, parameters=(), batch_rows=DATAFRAME_BATCH_ROWS):
+    """Run a guarded query and return its whole result as a pandas DataFrame backed by Arrow columns."""
+    def read(conn, query, parameters):
+        return read_dataframe(conn, query, parameters, batch_rows)
+    return run_guarded(query, parameters, read)
+
+
+def summarize_dataframe(dataframe, head_rows=SUMMARY_HEAD_ROWS, max_bytes=PAGE_BYTES):
+    """Return a compact text summary of a DataFrame: row count, statistics for every column and the first rows."""
+    lines = [f"rows: {len(dataframe)}", "columns:"]
+    for position, name in enumerate(dataframe.columns):
+        column = dataframe.iloc[:, position]
+        stats = [f"{name} ({column.dtype})", f"nulls={int(column.isna().sum())}"]
+        values = column.dropna()
+        if len(values) and pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype):
+            stats += [f"min={format_value(values.min())}", f"max={format_value(values.max())}", f"mean={values.mean():.4g}"]
+        elif len(values):
+            counts = values.value_counts()
+            stats += [f"distinct={len(counts)}", f"top={format_value(counts.index[0])} ({counts.iloc[0]})"]
+        lines.append("  " + ", ".join(stats))
+    lines.append("head:")
+    lines.append("\t".join(map(str, dataframe.columns)))
+    for row in dataframe.head(head_rows).itertuples(index=False):
+        lines.append("\t".join(format_value(None if pd.isna(value) else value) for value in row))
+    return "\n".join(lines).encode()[:max_bytes].decode(errors="ignore")
+
+
+def summarize_query(query, cursor=None, max_rows=PAGE_ROWS, max_bytes=PAGE_BYTES, parameters=()):
+    """Run a guarded query and return a summary of its whole result. Has the signature of run_query, so it can be cached the same way."""
+    return summarize_dataframe(query_dataframe(query, parameters), max_bytes=max_bytes)
+
+
+# Running queries in parallel
+# Because every call checks out its own connection, many database tool calls can run at the same time. 
+# call_database_tools runs a batch of calls on a thread pool, and async_ask_database lets asyncio code await a query without blocking the event loop.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+def call_database_tools(calls):
+    """Run several database tool calls in parallel. Each call is a (tool name, arguments dict) pair."""
+    with ThreadPoolExecutor(max_workers=database_pool.max_connections) as executor:
+        return list(executor.map(lambda call: database_functions[call[0]](**call[1]), calls))
+
+
+async def async_ask_database(query, cursor=None):
+    """Run ask_database in the default executor of the running event loop."""
+    return await asyncio.to_thread(ask_database, query, cursor)
+
+
+# Waiting for the whole final answer means the user sees nothing until the last token arrives. 
+# In streaming mode we print the tokens as they come in, and record the time to first token and the generation speed.
+
+stream = True
+
+def stream_chat_completion(messages, model=GPT_MODEL):
+    """Stream a chat completion to stdout and return the full content together with latency statistics."""
+    start = time.perf_counter()
+    first_token_at = None
+    content = ""
+    chunks = 0
+    completion_tokens = None
+    response = chat_completion_request(
+        messages,
+        model=model,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    for chunk in response:
+        # With include_usage the last chunk has no choices, only the token usage of the whole request
+        if chunk.usage is not None:
+            completion_tokens = chunk.usage.completion_tokens
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        chunks += 1
+        content += chunk.choices[0].delta.content
+        print(chunk.choices[0].delta.content, end="", flush=True)
+    end = time.perf_counter()
+    print()
+    completion_tokens = completion_tokens or chunks
+    generation_time = end - (first_token_at or end)
+    stats = {
+        "time_to_first_token": None if first_token_at is None else first_token_at - start,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / generation_time if generation_time > 0 else None,
+    }
+    return content, stats
 
 
 ## Showing the Database Schema
@@ -89,16 +1832,20 @@ print(f'\n\nDatabase Schema:\n\n{database_schema_string}')
 user_question = "What are the firstnames of the top 5 customers from the revenue they have given us?"
 print(f'\n\nUser Question:\n{user_question}\n\n')
 
+# Only the tables linked to the question go into the ask_database tool description
+question_tools, linked_tables = get_question_tools(user_question)
+print(f'Linked Tables: {[table["table_name"] for table in linked_tables]}\n\n')
+
 messages = [{
     "role":"user", 
     "content": user_question 
 }]
 
-response = client.chat.completions.create(
+response = chat_completion_request(
+    messages, 
+    tools=question_tools, 
+    tool_choice="auto",
     model='gpt-4o', 
-    messages=messages, 
-    tools= tools, 
-    tool_choice="auto"
 )
 
 # Append the message to messages list
@@ -110,32 +1857,64 @@ print(f'LLMS RAW Response:\n\n{response_message}\n\n')
 # Step 2: determine if the response from the model includes a tool call.   
 tool_calls = response_message.tool_calls
 if tool_calls:
-    # If true the model will return the name of the tool / function to call and the argument(s)  
-    tool_call_id = tool_calls[0].id
-    tool_function_name = tool_calls[0].function.name
-    tool_query_string = json.loads(tool_calls[0].function.arguments)['query']
+    # If true the model will return the name of the tool / function to call and the argument(s). 
+    # The model may ask several queries at once, so we run all of them in parallel, each on its own pooled connection.
+    database_calls = []
+    for tool_call in tool_calls:
+        if tool_call.function.name in database_functions:
+            database_calls.append(tool_call)
+        else:
+            print(f"Error: function {tool_call.function.name} does not exist")
+            # Every tool call needs an answer, otherwise the next request is rejected
+            messages.append({
+                "role":"tool", 
+                "tool_call_id":tool_call.id, 
+                "name": tool_call.function.name, 
+                "content":f"Error: function {tool_call.function.name} does not exist"
+            })
 
     # Step 3: Call the function and retrieve results. Append the results to the messages list.      
-    if tool_function_name == 'ask_database':
-        results = ask_database(conn, tool_query_string)
-        
+    database_arguments = [json.loads(tool_call.function.arguments) for tool_call in database_calls]
+    database_results = call_database_tools(
+        [(tool_call.function.name, arguments) for tool_call, arguments in zip(database_calls, database_arguments)]
+    )
+    for tool_call, arguments, results in zip(database_calls, database_arguments, database_results):
+        if tool_call.function.name == 'ask_database':
+            print(f'\n\nLLM Suggested SQL Query:\n\n{arguments["query"]}\n\n')
+        else:
+            print(f'\n\nLLM Chosen Query Template:\n\n{tool_call.function.name}({arguments})\n\n')
         messages.append({
             "role":"tool", 
-            "tool_call_id":tool_call_id, 
-            "name": tool_function_name, 
+            "tool_call_id":tool_call.id, 
+            "name": tool_call.function.name, 
             "content":results
         })
-        
+
+    if database_calls:
         # Step 4: Invoke the chat completions API with the function response appended to the messages list
         # Note that messages with role 'tool' must be a response to a preceding message with 'tool_calls'
-        model_response_with_function_call = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-        )  # get a new response from the model where it can see the function response
-        print(f'\n\nLLM Suggested SQL Query:\n\n{tool_query_string}\n\n')
-        print(model_response_with_function_call.choices[0].message.content)
-    else: 
-        print(f"Error: function {tool_function_name} does not exist")
+        if stream:
+            # Print the answer token by token as it is generated
+            content, stats = stream_chat_completion(messages, model="gpt-4o")
+            print(f'\nStreaming stats: {stats}')
+        else:
+            model_response_with_function_call = chat_completion_request(
+                messages,
+                model="gpt-4o",
+            )  # get a new response from the model where it can see the function response
+            print(model_response_with_function_call.choices[0].message.content)
 else: 
     # Model did not identify a function to call, result can be returned to the user 
-    print(response_message.content) 
\ No newline at end of file
+    print(response_message.content)
+
+print(f'\nQuery result cache: {query_result_cache.stats()}')
+print(f'Materialized summaries: {materialized_summaries.stats()}')
+if use_materialized_summaries:
+    print(f'Summary rewrite mismatches: {materialized_summaries.verify(database_pool, SUMMARY_CHECK_QUERIES)}')
+
+if run_index_advisor:
+    # Propose indexes for the queries seen so far and measure them on a writable copy of the database
+    for proposal in index_advisor.proposals():
+        print(f'Index proposal: {proposal["sql"]}')
+    for result in index_advisor.evaluate(database_pool):
+        print(f'Index advisor: {result["runs"]} runs, {result["before"] * 1000:.2f} ms -> {result["after"] * 1000:.2f} ms: {" ".join(result["query"].split())}')